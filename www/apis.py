@@ -1,4 +1,4 @@
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 class Page(object):
     '''
@@ -50,6 +50,82 @@ class Page(object):
     __repr__ = __str__
 
 
+class CursorPage(object):
+    '''
+    Page object for keyset(cursor) pagination, which does not need item_count or offset.
+    '''
+
+    def __init__(self, after='', page_size=10):
+        '''
+        Init Pagination by opaque cursor string and page_size. Empty cursor means the first page.
+        >>> p1 = CursorPage()
+        >>> p1.seek is None
+        True
+        >>> p1.limit
+        11
+        >>> p1.trim(list(range(11)), lambda n: (n, str(n)))
+        [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+        >>> p1.has_next
+        True
+        >>> p2 = CursorPage(p1.next_cursor)
+        >>> p2.seek
+        [9, '9']
+        >>> p2.has_previous
+        True
+        >>> p2.trim([10, 11], lambda n: (n, str(n)))
+        [10, 11]
+        >>> p2.has_next, p2.next_cursor
+        (False, '')
+        '''
+        self.page_size = page_size
+        self.after = after or ''
+        self.seek = decode_cursor(after) if after else None
+        self.limit = page_size + 1 # 多取一条用来判断是否还有下一页
+        self.has_next = False
+        self.has_previous = self.seek is not None
+        self.next_cursor = ''
+
+    def trim(self, items, key):
+        '''
+        Cut items to page_size and compute next_cursor from the last item by key function.
+        '''
+        self.has_next = len(items) > self.page_size
+        items = items[:self.page_size]
+        if self.has_next:
+            self.next_cursor = encode_cursor(key(items[-1]))
+        return items
+
+    def __str__(self):
+        return 'after: %s, page_size: %s, has_next: %s, next_cursor: %s' % (self.after, self.page_size, self.has_next, self.next_cursor)
+
+    __repr__ = __str__
+
+# 游标对外是不透明的字符串，内部是(排序字段值, 主键)的JSON
+def encode_cursor(seek):
+    return base64.urlsafe_b64encode(json.dumps(list(seek)).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    '''
+    Decode cursor to seek values, which must be 2 numbers or strings.
+    >>> decode_cursor(encode_cursor((1.5, 'id')))
+    [1.5, 'id']
+    >>> decode_cursor(encode_cursor(([1], {'a': 1})))
+    Traceback (most recent call last):
+      ...
+    apis.APIValueError: Invalid cursor
+    '''
+    try:
+        seek = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except ValueError:
+        raise APIValueError('after', 'Invalid cursor')
+    if not isinstance(seek, list) or len(seek) != 2:
+        raise APIValueError('after', 'Invalid cursor')
+    for v in seek:
+        if isinstance(v, bool) or not isinstance(v, (int, float, str)):
+            raise APIValueError('after', 'Invalid cursor')
+    return seek
+
+
 class APIError(Exception):
     '''
     the base APIError which contains error(required), data(optional) and message(optional).
@@ -1,6 +1,6 @@
 import logging; logging.basicConfig(level=logging.INFO)
 
-import asyncio, os, json, time
+import asyncio, os, re, time, signal, hashlib, mimetypes
 from datetime import datetime
 
 from aiohttp import web
@@ -9,7 +9,12 @@ from jinja2 import Environment, FileSystemLoader
 from config import configs
 
 import orm
-from coroweb import add_routes, add_static
+import serializer
+import compress
+from coroweb import add_routes, add_static, STATIC_PATH
+from writequeue import WriteQueue, QueueFullError
+from cache import LRUCache
+from models import Comment
 
 from handlers import cookie2user, COOKIE_NAME
 
@@ -38,46 +43,191 @@ def init_jinja2(app, **kw):
 	
 
 # 在正式处理之前打印日志
-@asyncio.coroutine
-def logger_factory(app,handler):
-	@asyncio.coroutine
-	def logger(request): 
+async def logger_factory(app,handler):
+	async def logger(request): 
 		logging.info('Requst : %s, %s' % (request.method, request.path))
-		return (yield from handler(request))
+		return await handler(request)
 	return logger
 
-@asyncio.coroutine
-def data_factory(app,handler):
-	@asyncio.coroutine
-	def parse_data(request):
+# 数据库连接池在acquire_timeout内取不到连接时直接返回503，不让请求一直排队；评论写队列满时返回429
+async def busy_factory(app, handler):
+	async def busy(request):
+		try:
+			return await handler(request)
+		except orm.PoolTimeoutError as e:
+			logging.warning('%s: %s %s' % (e, request.method, request.path))
+			return web.HTTPServiceUnavailable(text='Server is busy, please retry later.')
+		except QueueFullError as e:
+			logging.warning('%s: %s %s' % (e, request.method, request.path))
+			return web.HTTPTooManyRequests(text='Too many requests, please retry later.', headers={'Retry-After': '1'})
+	return busy
+
+async def data_factory(app,handler):
+	async def parse_data(request):
 		if request.method == 'POST':
 			if request.content_type.startswith('application/json'):
-				request.__data__ = yield from request.json()
+				request.__data__ = await request.json(loads=serializer.loads)
 				logging.info('request json : %s' % str(request.__data__))
 			elif request.content_type.startswith('application/x-www-form-urlencoded'):
-				request.__data__ = yield from request.post()
+				request.__data__ = await request.post()
 				logging.info('request form : %s' % str(request.__data__))
-		return (yield from handler(request))
+		return await handler(request)
 	return parse_data
 	
 # 是为了验证当前的这个请求用户是否在登录状态下，或是否是伪造的sha1
-@asyncio.coroutine
-def auth_factory(app, handler):
-	@asyncio.coroutine
-	def auth(request):
+async def auth_factory(app, handler):
+	async def auth(request):
 		logging.info('check user: %s %s' % (request.method, request.path))
 		request.__user__ = None
 		cookie_str = request.cookies.get(COOKIE_NAME)
 		if cookie_str:
-			user = yield from cookie2user(cookie_str)
+			user = await cookie2user(cookie_str)
 			if user:
 				logging.info('set current user: %s' % user.email)
 				request.__user__ = user
 		if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
 			return web.HTTPFound('/signin')
-		return (yield from handler(request))
+		return await handler(request)
 	return auth
 
+# 响应压缩：/static/下的文件有比它新的预压缩.br/.gz文件且客户端接受时直接发送压缩文件
+# 其它不小于threshold字节的文本响应按Accept-Encoding压缩，不小于executor_threshold字节的放到线程池里压缩，不阻塞事件循环
+async def compress_factory(app, handler):
+	async def compressed(request):
+		accept = request.headers.get('Accept-Encoding')
+		if accept and request.method == 'GET' and request.path.startswith('/static/'):
+			r = _precompressed(request.path[len('/static/'):], accept)
+			if r is not None:
+				return r
+		r = await handler(request)
+		if isinstance(r, web.HTTPNotModified):
+			return _encoded_not_modified(request, r, accept)
+		options = configs.compress
+		if type(r) is not web.Response or r.status != 200 or r.body is None or len(r.body) < options.threshold:
+			return r
+		if 'Content-Encoding' in r.headers or not compress.compressible(r.headers.get('Content-Type')):
+			return r
+		r.headers['Vary'] = 'Accept-Encoding'
+		encoding = compress.choose_encoding(accept)
+		if encoding is None:
+			return r
+		if len(r.body) >= options.executor_threshold:
+			r.body = await asyncio.get_event_loop().run_in_executor(None, compress.compress, encoding, r.body, options.level)
+		else:
+			r.body = compress.compress(encoding, r.body, options.level)
+		r.headers['Content-Encoding'] = encoding
+		etag = r.headers.get('ETag')
+		if etag:#同一个资源不同编码的强ETag必须不同
+			r.headers['ETag'] = '%s-%s"' % (etag[:-1], encoding)
+		return r
+	return compressed
+
+# 304要带上和200相同的ETag：etag_factory比较时去掉了编码后缀，这里补回来
+# 客户端用If-None-Match验证时沿用匹配上的那个ETag的后缀，只用If-Modified-Since时按Accept-Encoding选
+def _encoded_not_modified(request, r, accept):
+	etag = r.headers.get('ETag')
+	if not etag:
+		return r
+	header = request.headers.get('If-None-Match')
+	if header:
+		encoding = None
+		for t in header.split(','):
+			m = _RE_ETAG_SUFFIX.match(t.strip())
+			if m and m.group(1) + '"' == etag and m.group(2):
+				encoding = m.group(2)[1:]
+				break
+	else:
+		encoding = compress.choose_encoding(accept)
+	if encoding is not None:
+		r.headers['ETag'] = '%s-%s"' % (etag[:-1], encoding)
+		r.headers['Vary'] = 'Accept-Encoding'
+	return r
+
+def _precompressed(name, accept):
+	path = os.path.normpath(os.path.join(STATIC_PATH, name))
+	if not path.startswith(STATIC_PATH + os.sep):
+		return None
+	found = compress.find_precompressed(path, accept)
+	if found is None:
+		return None
+	sibling, encoding = found
+	content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+	return web.FileResponse(sibling, headers={'Content-Type': content_type, 'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'})
+
+# 每个表在本进程中的写入版本号和最后写入时间，由orm的写表回调在事务提交后更新
+# 版本只在本进程内有效，所以ETag里带上进程启动时间，重启后旧的ETag全部失效
+# 只适用于单进程部署：多个进程时没看到写入的进程会一直回答304，要把etag.versioned设为False
+# 配置了只读副本时也不使用：读到落后的副本会让旧内容带上新版本的ETag
+_BOOT_TIME = time.time()
+_table_versions = {}
+
+def bump_table_version(table):
+	version = _table_versions.get(table, (0, _BOOT_TIME))[0]
+	_table_versions[table] = (version + 1, time.time())
+
+# 压缩后的响应ETag带有-gzip/-br后缀，比较时去掉
+_RE_ETAG_SUFFIX = re.compile(r'^(?:W/)?(".*?)(-gzip|-br)?"$')
+
+def _etag_matches(request, etag):
+	header = request.headers.get('If-None-Match')
+	if not header:
+		return False
+	if header.strip() == '*':
+		return True
+	return etag in [_RE_ETAG_SUFFIX.sub(r'\1"', t.strip()) for t in header.split(',')]
+
+# 条件GET：200的响应都带上强ETag，请求的If-None-Match或If-Modified-Since仍然有效时返回304
+# @versioned声明了依赖的表且app['__versioned_etags__']打开时，ETag由路径、当前用户和各表的写入版本算出，不用调用处理函数就能回答304
+# 其它响应的ETag是响应体的哈希，还是要先生成响应，只省下传输
+async def etag_factory(app, handler):
+	async def conditional(request):
+		if request.method != 'GET':
+			return await handler(request)
+		tables = None
+		if app['__versioned_etags__']:
+			tables = getattr(getattr(request.match_info.handler, '_func', None), '__tables__', None)
+		etag = last_modified = None
+		if tables:
+			versions = [_table_versions.get(t, (0, _BOOT_TIME)) for t in tables]
+			last_modified = max(v[1] for v in versions)
+			key = '%s:%s:%s:%s' % (_BOOT_TIME, request.path_qs, request.__user__.id if request.__user__ else '', ','.join(str(v[0]) for v in versions))
+			etag = '"%s"' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+			if _etag_matches(request, etag):
+				return web.HTTPNotModified(headers={'ETag': etag})
+			since = request.if_modified_since
+			if 'If-None-Match' not in request.headers and since is not None and since.timestamp() >= int(last_modified):
+				return web.HTTPNotModified(headers={'ETag': etag})
+		r = await handler(request)
+		if type(r) is not web.Response or r.status != 200 or r.body is None:
+			return r
+		if etag is None:
+			etag = '"%s"' % hashlib.sha1(r.body).hexdigest()
+			if _etag_matches(request, etag):
+				return web.HTTPNotModified(headers={'ETag': etag})
+		r.headers['ETag'] = etag
+		if last_modified is not None:
+			r.last_modified = last_modified
+		return r
+	return conditional
+
+# 缓存@cached处理函数经过response_factory渲染后的响应，放在auth_factory之后才能知道是不是匿名用户
+async def cache_factory(app, handler):
+	async def cached_response(request):
+		options = getattr(getattr(request.match_info.handler, '_func', None), '__cache__', None)
+		if options is None or request.method != 'GET' or request.__user__ is not None:
+			return await handler(request)
+		cache = app['__response_cache__']
+		key = (request.path_qs,) + tuple(request.headers.get(h, '') for h in options['vary'])
+		hit = cache.get(key)
+		if hit is not None:
+			return web.Response(status=hit[0], body=hit[2], headers={'Content-Type': hit[1]})
+		generation = cache.generation(options['tables'])#渲染期间依赖的表被写过时不缓存这次的响应
+		r = await handler(request)
+		if type(r) is web.Response and r.status == 200 and not r.cookies:
+			cache.set(key, (r.status, r.headers.get('Content-Type'), r.body), ttl=options['ttl'], tags=options['tables'], generation=generation)
+		return r
+	return cached_response
+
 # 响应处理
 # 总结下来一个请求在服务端收到后的方法调用顺序是:
 #     	logger_factory->response_factory->RequestHandler().__call__->get或post->handler
@@ -88,12 +238,10 @@ def auth_factory(app, handler):
 #     	response_factory在拿到经过处理后的对象，经过一系列对象类型和格式的判断，构造出正确web.Response对象，以正确的方式返回给客户端
 # 在这个过程中，我们只用关心我们的handler的处理就好了，其他的都走统一的通道，如果需要差异化处理，就在通道中选择适合的地方添加处理代码。
 # 在response_factory中应用了jinja2来套用模板
-@asyncio.coroutine
-def response_factory(app, handler):
-	@asyncio.coroutine
-	def response(request):
+async def response_factory(app, handler):
+	async def response(request):
 		logging.info('Response handler...')
-		r = yield from handler(request)
+		r = await handler(request)
 		if isinstance(r, web.StreamResponse):
 			return r
 		if isinstance(r, bytes):
@@ -109,7 +257,7 @@ def response_factory(app, handler):
 		if isinstance(r, dict):
 			template = r.get('__template__')
 			if template is None:
-				resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+				resp = web.Response(body=serializer.dumps(r))
 				resp.content_type = 'application/json;charset=utf-8'
 				return resp
 			else:
@@ -144,22 +292,48 @@ def datetime_filter(t):
 	return  u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 	
 	
-@asyncio.coroutine
-def init(loop):
-	yield from orm.create_pool(loop=loop,**configs.db)#与数据库连接
+async def init(loop):
+	serializer.use_backend(configs.serializer.backend)
+	await orm.create_pool(loop=loop,**configs.db)#与数据库连接，监听端口之前先建好warmup个连接
+	await orm.check_indexes()#缺少索引时只打印警告，不影响启动
 	# middlewares设置三个中间处理函数
 	# middlewares中的每个factory接受两个参数，app 和 handler(即middlewares中得下一个handler)
 	#即这里logger_factory的handler参数其实就是auth_factory()
 	# middlewares的最后一个元素的Handler会通过routes查找到相应的,经过routes注册的对应handler
-	app = web.Application(loop=loop, middlewares=[logger_factory, auth_factory, response_factory])
+	app = web.Application(loop=loop, middlewares=[logger_factory, busy_factory, compress_factory, auth_factory, etag_factory, cache_factory, response_factory])
+	app['__response_cache__'] = LRUCache(maxsize=configs.response_cache.maxsize)
+	orm.add_write_listener(app['__response_cache__'].invalidate)#写表时让依赖这个表的页面缓存失效
+	orm.add_write_listener(bump_table_version)
+	app['__versioned_etags__'] = configs.etag.versioned and not orm.has_replicas()
+	if configs.etag.versioned and orm.has_replicas():
+		logging.warning('read replicas configured, versioned etags disabled.')
 	init_jinja2(app, filters=dict(datetime=datetime_filter))
 	add_routes(app, 'handlers')
 	add_static(app)
-	srv = yield from loop.create_server(app.make_handler(),'127.0.0.1',9000)#建立服务器
+	queue = configs.comment_queue
+	if queue.enabled:#评论先进写队列，由后台批量插入
+		app['comment_queue'] = WriteQueue(Comment, loop, maxsize=queue.maxsize, interval=queue.interval, batch=queue.batch)
+		app.on_shutdown.append(close_queues)
+	await loop.create_server(app.make_handler(),'127.0.0.1',9000)#建立服务器
 	logging.info('server started at http://127.0.0.1:9000...')
-	return srv
+	return app
+
+#关闭前把写队列里剩下的对象写进数据库
+async def close_queues(app):
+	queue = app['comment_queue']
+	logging.info('flush %s queued comment(s)...' % len(queue))
+	await queue.close()
 
 
 loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))#把协程放入EVENTLOOP中
-loop.run_forever()#令程序一直运行监听请求
+app = loop.run_until_complete(init(loop))#把协程放入EVENTLOOP中
+try:
+	loop.add_signal_handler(signal.SIGTERM, loop.stop)
+except NotImplementedError:#Windows不支持
+	pass
+try:
+	loop.run_forever()#令程序一直运行监听请求
+except KeyboardInterrupt:
+	pass
+finally:
+	loop.run_until_complete(app.shutdown())
@@ -0,0 +1,176 @@
+#测量coroweb.RequestHandler每个请求的分派开销：解析参数、绑定参数和调用处理函数，不包括网络和中间件
+#LegacyRequestHandler保留了预编译绑定之前的通用绑定逻辑，作为对照，并先检查两者对同样的请求绑定出同样的参数
+#用法：python3 bench_dispatch.py [每种路由的请求次数]
+import sys, time, json, asyncio, logging
+from urllib import parse
+
+from aiohttp import web
+from coroweb import get, post, RequestHandler, get_required_kw_args, get_named_kw_args, has_named_kw_args, has_var_kw_arg, has_request_arg
+from apis import APIError
+
+class FakeRequest(object):
+
+	def __init__(self, method, query_string='', match_info=None, content_type='', body=None):
+		self.method = method
+		self.query_string = query_string
+		self.match_info = match_info or {}
+		self.content_type = content_type
+		self._body = body if body is not None else {}
+
+	async def json(self, loads=None):
+		return json.loads(json.dumps(self._body))#每次返回新的对象，和真的解析请求体一样
+
+	async def post(self):
+		return dict(self._body)
+
+#预编译绑定之前RequestHandler.__call__的参数绑定，bind返回kw或者400响应
+#HTTPBadRequest的消息改成了text=关键字参数，原来的位置参数在aiohttp 3里会抛出TypeError
+class LegacyRequestHandler(object):
+	def __init__(self, app, fn):
+		self._app = app
+		self._func = fn
+		self._has_request_arg = has_request_arg(fn)
+		self._has_var_kw_arg = has_var_kw_arg(fn)
+		self._has_named_kw_args = has_named_kw_args(fn)
+		self._named_kw_args = get_named_kw_args(fn)
+		self._required_kw_args = get_required_kw_args(fn)
+
+	async def bind(self, request):
+		kw = None
+		if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
+			if request.method == 'POST':
+				if not request.content_type:
+					return web.HTTPBadRequest(text='Missing Content_Type.')
+				ct = request.content_type.lower()
+				if ct.startswith('application/json'):
+					params = await request.json()
+					if not isinstance(params,dict):
+						return web.HTTPBadRequest(text='JSON body must be object.')
+					kw = params
+				elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+					params = await request.post()
+					kw = dict(**params)
+				else:
+					return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+			if request.method == 'GET':
+				qs = request.query_string
+				if qs:
+					kw = dict()
+					for k,v in parse.parse_qs(qs,True).items():
+						kw[k] = v[0]
+		if kw is None:
+			kw = dict(**request.match_info)
+		else:
+			if not self._has_var_kw_arg and self._named_kw_args:
+				copy = dict()
+				for name in self._named_kw_args:
+					if name in kw:
+						copy[name] = kw[name]
+				kw = copy
+			for k,v in request.match_info.items():
+				if k in kw:
+					logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
+				kw[k] = v
+		if self._has_request_arg:
+			kw['request'] = request
+		if self._required_kw_args:
+			for name in self._required_kw_args:
+				if not name in kw:
+					return web.HTTPBadRequest(text='Missing argument: %s' % name)
+		return kw
+
+	async def __call__(self, request):
+		kw = await self.bind(request)
+		if not isinstance(kw, dict):
+			return kw
+		logging.info('call with args: %s' % str(kw))
+		try:
+			return await self._func(**kw)
+		except APIError as e:
+			return dict(error=e.error, data=e.data, message=e.message)
+
+@get('/')
+def index():
+	return {}
+
+@get('/api/blogs')
+async def api_blogs(*, page='1', after=None):
+	return page
+
+@get('/blog/{id}')
+async def get_blog(id):
+	return id
+
+@post('/api/blogs/{id}')
+async def api_update_blog(id, request, *, name, summary, content):
+	return id
+
+@get('/manage/blogs/edit')
+def manage_edit_blog(*, id):
+	return id
+
+@post('/api/raw/{id}')
+def api_raw(id, **kw):
+	return kw
+
+CASES = [
+	('GET / (plain function)', index, FakeRequest('GET')),
+	('GET /api/blogs?page=2', api_blogs, FakeRequest('GET', 'page=2&size=10')),
+	('GET /blog/{id}', get_blog, FakeRequest('GET', match_info={'id': '001'})),
+	('POST /api/blogs/{id} json', api_update_blog, FakeRequest('POST', match_info={'id': '001'}, content_type='application/json', body={'name': 'n', 'summary': 's', 'content': 'c'}))
+]
+
+#绑定结果要一致的请求：同名参数、没有参数、表单、match_info重名、缺少必须参数、不支持的内容类型等
+CHECKS = CASES + [
+	('GET repeated keys', api_blogs, FakeRequest('GET', 'page=2&page=3&after=&x=1')),
+	('GET no query', api_blogs, FakeRequest('GET')),
+	('GET missing required', manage_edit_blog, FakeRequest('GET', 'x=1')),
+	('GET required from query', manage_edit_blog, FakeRequest('GET', 'id=7')),
+	('POST form', api_update_blog, FakeRequest('POST', match_info={'id': '1'}, content_type='application/x-www-form-urlencoded', body={'name': 'n', 'summary': 's', 'content': 'c', 'x': 'y'})),
+	('POST match_info overlap', api_raw, FakeRequest('POST', match_info={'id': '1'}, content_type='application/json; charset=utf-8', body={'id': '2', 'a': 1})),
+	('POST missing required', api_update_blog, FakeRequest('POST', match_info={'id': '1'}, content_type='application/json', body={'name': 'n'})),
+	('POST json array', api_update_blog, FakeRequest('POST', match_info={'id': '1'}, content_type='application/json', body=[1])),
+	('POST no content type', api_update_blog, FakeRequest('POST', match_info={'id': '1'})),
+	('POST unsupported type', api_update_blog, FakeRequest('POST', match_info={'id': '1'}, content_type='text/plain'))
+]
+
+async def bind_new(handler, request):
+	try:
+		return await handler._bind(request)
+	except web.HTTPBadRequest as e:
+		return e
+
+def check(loop):
+	failed = 0
+	for name, fn, request in CHECKS:
+		old = loop.run_until_complete(LegacyRequestHandler(None, fn).bind(request))
+		new = loop.run_until_complete(bind_new(RequestHandler(None, fn), request))
+		same = (type(old) is type(new) and old.text == new.text) if isinstance(old, web.HTTPBadRequest) else old == new
+		if not same:
+			failed += 1
+			print('MISMATCH %s: %r != %r' % (name, old, new))
+	print('%s binding check(s), %s mismatch(es).' % (len(CHECKS), failed))
+	return failed == 0
+
+async def bench(handler, request, n):
+	start = time.perf_counter()
+	for i in range(n):
+		await handler(request)
+	return (time.perf_counter() - start) / n
+
+def main(n):
+	loop = asyncio.new_event_loop()
+	if not check(loop):
+		exit(1)
+	print('%-32s %10s %10s' % ('', 'legacy', 'binder'))
+	for name, fn, request in CASES:
+		times = []
+		for cls in (LegacyRequestHandler, RequestHandler):
+			handler = cls(None, fn)
+			loop.run_until_complete(bench(handler, request, n // 10))#预热
+			times.append(loop.run_until_complete(bench(handler, request, n)))
+		print('%-32s %7.2f us %7.2f us' % (name, times[0] * 1e6, times[1] * 1e6))
+	loop.close()
+
+if __name__ == '__main__':
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
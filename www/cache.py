@@ -0,0 +1,64 @@
+import time
+from collections import OrderedDict
+
+#带过期时间的LRU缓存，超过maxsize时淘汰最久没用过的条目
+#每个条目可以打上多个tag(如表名)，invalidate(tag)删除打了这个tag的所有条目
+#每个tag有失效计数：读数据前用generation(tags)记下计数，set时带上它，期间tag失效过就不写入
+#否则查询开始后、写入缓存前发生的失效删不到还没写入的条目，旧数据会一直留到过期
+class LRUCache(object):
+
+    def __init__(self, maxsize=1000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict() # key -> (过期时间, 值, tags)
+        self._tags = {} # tag -> set(key)
+        self._generations = {} # tag -> 失效次数
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        if entry[0] < time.time():
+            self._remove(key)
+            return default
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def generation(self, tags):
+        return tuple(self._generations.get(tag, 0) for tag in tags)
+
+    def set(self, key, value, ttl=None, tags=(), generation=None):
+        if self.maxsize <= 0:
+            return
+        if generation is not None and generation != self.generation(tags):
+            return
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (time.time() + (self.ttl if ttl is None else ttl), value, tuple(tags))
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._data) > self.maxsize:
+            self._remove(next(iter(self._data)))
+
+    def invalidate(self, tag):
+        self._generations[tag] = self._generations.get(tag, 0) + 1
+        for key in list(self._tags.get(tag, ())):
+            self._remove(key)
+
+    def clear(self):
+        self._data.clear()
+        self._tags.clear()
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
@@ -0,0 +1,89 @@
+import os, gzip, logging
+
+try:
+    import brotli
+except ImportError:#没装brotli时只用gzip
+    brotli = None
+
+#响应压缩：动态响应在发送前按客户端的Accept-Encoding压缩，静态文件在构建时预先压缩好.gz/.br放在原文件旁边
+#优先使用br，其次gzip
+
+#值得压缩的内容类型，图片和字体等本身已经压缩过的不再压缩
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+COMPRESSIBLE_EXTS = ('.css', '.js', '.html', '.json', '.svg', '.txt', '.map', '.xml', '.eot', '.ttf', '.otf')
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+def compressible(content_type):
+    return bool(content_type) and content_type.startswith(COMPRESSIBLE_TYPES)
+
+#解析Accept-Encoding，按优先顺序返回客户端接受的、本机支持的编码
+def accepted_encodings(accept_encoding):
+    if not accept_encoding:
+        return []
+    accepted = set()
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if q > 0:
+            accepted.add(name.strip().lower())
+    return [e for e in ENCODINGS if e in accepted or '*' in accepted]
+
+#返回最优先的编码，都不接受时返回None
+def choose_encoding(accept_encoding):
+    encodings = accepted_encodings(accept_encoding)
+    return encodings[0] if encodings else None
+
+def compress(encoding, body, level=6):
+    if encoding == 'br':
+        return brotli.compress(body, quality=min(level, 11))
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+#找到静态文件旁边比它新的预压缩文件，返回(文件路径, 编码)，没有时返回None
+def find_precompressed(path, accept_encoding):
+    encodings = accepted_encodings(accept_encoding)
+    if not encodings:
+        return None
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    for e in encodings:
+        sibling = path + SUFFIXES[e]
+        try:
+            if os.stat(sibling).st_mtime >= mtime:
+                return sibling, e
+        except OSError:
+            pass
+    return None
+
+#为目录下所有值得压缩的文件生成.gz和.br(装了brotli时)，已经是最新的跳过，返回生成的文件数
+def precompress_dir(root, threshold=1024):
+    n = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if not name.endswith(COMPRESSIBLE_EXTS):
+                continue
+            path = os.path.join(dirpath, name)
+            st = os.stat(path)
+            if st.st_size < threshold:
+                continue
+            with open(path, 'rb') as f:
+                body = None
+                for e in ENCODINGS:
+                    target = path + SUFFIXES[e]
+                    if os.path.exists(target) and os.stat(target).st_mtime >= st.st_mtime:
+                        continue
+                    if body is None:
+                        body = f.read()
+                    with open(target, 'wb') as out:
+                        out.write(compress(e, body, 9))
+                    logging.info('compressed %s -> %s' % (path, target))
+                    n += 1
+    return n
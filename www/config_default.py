@@ -1,11 +1,50 @@
 configs = {
     'debug': True,
     'db': {
+        'driver': 'mysql',
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'root',
         'password': 'password1',
-        'datebase': 'awesome'
+        'datebase': 'awesome',
+        'minsize': 1,
+        'maxsize': 10,
+        'warmup': 5,
+        'acquire_timeout': 5,
+        'idle_check': 60,
+        'pool_recycle': 3600,
+        'adaptive': False,
+        'count_ttl': 60,
+        'replicas': [],
+        'replica_policy': 'round_robin',
+        'read_your_writes': True,
+        'identity_map': True,
+        'cache_size': 1000,
+        'slow_query': 0.5,
+        'slow_query_interval': 600
+    },
+    'comment_queue': {
+        'enabled': False,
+        'maxsize': 1000,
+        'interval': 0.005,
+        'batch': 100
+    },
+    'response_cache': {
+        'maxsize': 500
+    },
+    'serializer': {
+        'backend': 'auto'
+    },
+    'etag': {
+        'versioned': True
+    },
+    'compress': {
+        'threshold': 1024,
+        'executor_threshold': 65536,
+        'level': 6
+    },
+    'metrics': {
+        'token': ''
     },
     'session': {
         'secret': 'Awesome'
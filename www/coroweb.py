@@ -1,14 +1,28 @@
-import functools,inspect,asyncio,logging,os
+import functools,inspect,logging,os,types
 from urllib import parse
 from aiohttp import web 
 from apis import APIError
+import serializer
+
+#把普通函数和生成器函数(旧的@asyncio.coroutine写法)包装成原生协程函数，原生协程函数原样返回
+#生成器函数要先用types.coroutine标记成基于生成器的协程，里面才能yield from原生协程(如orm的方法)
+def coroutine(fn):
+	if inspect.iscoroutinefunction(fn):
+		return fn
+	if inspect.isgeneratorfunction(fn):
+		fn = types.coroutine(fn)
+	@functools.wraps(fn)
+	async def wrapper(*args,**kw):
+		r = fn(*args,**kw)
+		if inspect.isawaitable(r):
+			r = await r
+		return r
+	return wrapper
 
 #把一个函数映射成一个处理URL函数，编写@get@post，通过装饰器可以让URL处理函数带有URL信息
 def get(path):
 	def decorator(func):
-		@functools.wraps(func)
-		def wrapper(*args,**kw):
-			return func(*args,**kw)
+		wrapper = coroutine(func)
 		wrapper.__method__ = 'GET'
 		wrapper.__route__ = path
 		return wrapper
@@ -16,14 +30,29 @@ def get(path):
 
 def post(path):
 	def decorator(func):
-		@functools.wraps(func)
-		def wrapper(*args,**kw):
-			return func(*args,**kw)
+		wrapper = coroutine(func)
 		wrapper.__method__ = 'POST'
 		wrapper.__route__ = path
 		return wrapper
 	return decorator
 
+#声明处理函数渲染后的响应可以缓存ttl秒，可以写在@get的上面或下面，由app里的cache_factory使用
+#只缓存匿名用户GET请求的200响应，key为路径和查询参数，vary中请求头的值也加入key
+#tables为响应依赖的表，这些表被写入时缓存立即失效
+def cached(ttl=60, vary=(), tables=()):
+	def decorator(func):
+		func.__cache__ = dict(ttl=ttl, vary=tuple(vary), tables=tuple(tables))
+		return func
+	return decorator
+
+#声明处理函数的响应只由这些表的内容决定，app里的etag_factory按表的写入版本生成ETag
+#请求带着仍然有效的ETag或Last-Modified时不调用处理函数，直接返回304
+def versioned(*tables):
+	def decorator(func):
+		func.__tables__ = tables
+		return func
+	return decorator
+
 #获取函数的必须要赋值的KEYWORD_ONLY参数
 def get_required_kw_args(fn):
 	args = []
@@ -70,81 +99,107 @@ def has_request_arg(fn):
 			raise ValueError('request parameter must be the last named parameter in function: %s%s' % (fn.__name__, str(sig))) 
 	return found
 
+#读取POST请求体里的参数，json和表单以外的内容类型返回400
+async def read_body(request):
+	if not request.content_type:#请求中没有内容类型报错
+		raise web.HTTPBadRequest(text='Missing Content_Type.')
+	ct = request.content_type.lower()
+	if ct.startswith('application/json'):#检查content-type形式，给出对应处理request方法
+		params = await request.json(loads=serializer.loads)
+		if not isinstance(params,dict):
+			raise web.HTTPBadRequest(text='JSON body must be object.')
+		return params
+	if ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+		params = await request.post()
+		return dict(**params)
+	raise web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+
+#读取url中?后面的参数，同名参数只取第一个值
+async def read_query(request):
+	qs = request.query_string
+	if not qs:
+		return None
+	kw = dict()
+	for k,v in parse.parse_qsl(qs,True):
+		kw.setdefault(k,v)
+	return kw
+
+#按请求方法选择读取参数的方式
+async def read_params(request):
+	if request.method == 'POST':
+		return await read_body(request)
+	if request.method == 'GET':
+		return await read_query(request)
+	return None
+
+# 在注册路由时按处理函数的签名生成参数绑定函数bind(request)，返回调用处理函数的kw：
+# 1.处理函数没有关键字参数时只取match_info，不解析请求
+# 2.否则按路由的方法只保留读取请求体或查询参数的分支；没有读到参数时kw为match_info
+# 3.没有VAR_KEYWORD参数时只保留命名关键字参数，再合并match_info
+# 4.需要request参数时加入request，最后检查必须的关键字参数，缺少时抛出HTTPBadRequest
+def make_binder(fn):
+	has_request = has_request_arg(fn)
+	named = get_named_kw_args(fn)
+	required = get_required_kw_args(fn)
+	required_set = frozenset(required)
+	names = None if has_var_kw_arg(fn) else named
+
+	def finish(kw, request):
+		if has_request:
+			kw['request'] = request
+		if required_set and not required_set.issubset(kw):
+			for name in required:
+				if name not in kw:
+					raise web.HTTPBadRequest(text='Missing argument: %s' % name)
+		return kw
+
+	if names is not None and not names:
+		async def bind(request):
+			return finish(dict(**request.match_info), request)
+		return bind
+
+	read = dict(GET=read_query, POST=read_body).get(getattr(fn, '__method__', None), read_params)
+	async def bind(request):
+		params = await read(request)
+		if params is None:
+			return finish(dict(**request.match_info), request)
+		if names is not None:
+			kw = {name: params[name] for name in names if name in params}#找到request中参数与函数参数相同的，保存下来
+		else:
+			kw = params
+		for k,v in request.match_info.items():
+			if k in kw:
+				logging.warning('Duplicate arg name in named arg and kw args: %s' % k)  # 命名参数和关键字参数有名字重复
+			kw[k] = v
+		return finish(kw, request)
+	return bind
+
 #RequestHandler目的就是从URL函数中分析其需要接收的参数，从request中获取必要的参数
+#参数的绑定方式在创建时由make_binder按函数签名生成，每个请求只执行这个函数需要的分支
 class RequestHandler(object):
 	def __init__(self, app, fn):
 		self._app = app#一个下划线开头声明是私有变量，但是可以外部调用
 		self._func = fn
-		self._has_request_arg = has_request_arg(fn)
-		self._has_var_kw_arg = has_var_kw_arg(fn)
-		self._has_named_kw_args = has_named_kw_args(fn)
-		self._named_kw_args = get_named_kw_args(fn)
-		self._required_kw_args = get_required_kw_args(fn)
-	
-	# __call__方法的代码逻辑:
-	# 1.定义kw对象，用于保存参数
-	# 2.判断request对象是否存在参数，如果存在则根据是POST还是GET方法将参数内容保存到kw
-	# 3.如果kw为空(说明request没有传递参数)，则将match_info列表里面的资源映射表赋值给kw；如果不为空则把命名关键字参数的内容给kw
-	# 4.完善_has_request_arg和_required_kw_args属性
-	@asyncio.coroutine
-	def __call__(self,request):#__call__方法能够实现实例的直接调用
-		kw = None
-		if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-			if request.method == 'POST':
-				if not request.content_type:#请求中没有内容类型报错
-					return web.HTTPBadRequest(text='Missing Content_Type.')
-				ct = request.content_type.lower()
-				if ct.startswith('application/json'):#检查content-type形式，给出对应处理request方法
-					params = yield from request.json()
-					if not isinstance(params,dict):#??json是一个dict类型？？
-						return web.HTTPBadRequest(text='JSON body must be object.')
-					kw = params #保存请求参数
-				elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-					params = yield from request.post()
-					kw = dict(**params)
-				else:
-					return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
-			if request.method == 'GET': # get方法比较简单，直接后面跟了string来请求服务器上的资源
-				qs = request.query_string
-				if qs:
-					# 该方法解析url中?后面的键值对内容保存到kw
-					kw = dict()
-					for k,v in parse.parse_qs(qs,True).items():#The dictionary keys are the unique variable names and the values are lists of values for each name.
-						kw[k] = v[0]#？？为什么每个k都赋值成V[0]
-		if kw is None:# 参数为空说明没有从Request对象中获取到必要参数
-			kw = dict(**request.match_info)
-			 # 此时kw指向match_info属性，一个变量标识符的名字的dict列表。Request中获取的命名关键字参数必须要在这个dict当中
-		else:
-			if not self._has_var_kw_arg and self._named_kw_args:#有KEYWORD_ONLY参数没有VAR_KEYWORD
-				copy = dict()
-				for name in self._named_kw_args:
-					if name in kw:
-						copy[name] = kw[name]#找到request中参数与函数参数相同的，保存下来
-				kw = copy
-			for k,v in request.match_info.items():
-				if k in kw:
-						logging.warning('Duplicate arg name in named arg and kw args: %s' % k)  # 命名参数和关键字参数有名字重复
-				kw[k] = v
-		if self._has_request_arg:
-			kw['request'] = request
-		#检查函数是否有必要关键字参数，KW中如果没有返回错误信息
-		if self._required_kw_args:
-			for name in self._required_kw_args:
-				if not name in kw:
-					return web.HTTPBadRequest('Missing argument: %s' % name)
-		logging.info('call with args: %s' % str(kw))
+		self._bind = make_binder(fn)
+
+	async def __call__(self,request):#__call__方法能够实现实例的直接调用
 		try:
-			r = yield from self._func(**kw)#给URL处理函数传入对应的参数，执行URL处理函数
-			return r
+			kw = await self._bind(request)
+		except web.HTTPBadRequest as e:
+			return e
+		logging.debug('call with args: %s', kw)
+		try:
+			return await self._func(**kw)#给URL处理函数传入对应的参数，执行URL处理函数
 		except APIError as e:
 			return dict(error=e.error, data=e.data, message=e.message)
-			
-			
+
+
 # 添加静态页面的路径
+STATIC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
 def add_static(app):
-	path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-	app.router.add_static('/static/',path) 
-	logging.info('add static %s => %s' % ('/static/', path))
+	app.router.add_static('/static/',STATIC_PATH) 
+	logging.info('add static %s => %s' % ('/static/', STATIC_PATH))
 	
 #注册一个URL处理函数
 def add_route(app,fn):
@@ -152,8 +207,7 @@ def add_route(app,fn):
 	path = getattr(fn,'__route__',None)
 	if path is None or method is None:
 		raise ValueError('@get or @post not defined in %s.' % str(fn))
-	if not asyncio.iscoroutine(fn) and  not inspect.isgeneratorfunction(fn):
-		fn = asyncio.coroutine(fn)#处理URL函数必须是协程
+	fn = coroutine(fn)#处理URL函数必须是原生协程
 	logging.info('add route %s %s => %s (%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
 	app.router.add_route(method, path, RequestHandler(app, fn))
 
@@ -0,0 +1,236 @@
+import asyncio, logging, sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import aiomysql
+except ImportError:#只用SQLite时可以不装aiomysql
+    aiomysql = None
+
+#数据库驱动层：orm只通过驱动建连接池、选游标类型和转换SQL，连接池和连接的接口都和aiomysql一样
+#驱动需要提供：
+#    create_pool(loop, kw)  建连接池的协程
+#    Cursor / DictCursor / SSDictCursor  游标类型，分别返回tuple行、dict行、流式dict行
+#    sql(sql)  把orm里?占位符的SQL转成驱动的格式
+#    EXPLAIN  查看执行计划的前缀
+#    TABLE_OPTIONS  建表语句最后的选项
+#    INDEX_SQL  列出表上索引的查询，返回t(表名), i(索引名), c(字段名)，按索引里字段的顺序排列
+
+class MySQLDriver(object):
+
+    name = 'mysql'
+    EXPLAIN = 'explain '
+    TABLE_OPTIONS = ' engine=innodb default charset=utf8'
+    INDEX_SQL = 'select `table_name` `t`, `index_name` `i`, `column_name` `c` from information_schema.statistics where table_schema = database() order by `table_name`, `index_name`, `seq_in_index`'
+
+    def __init__(self):
+        if aiomysql is not None:
+            self.Cursor = aiomysql.Cursor
+            self.DictCursor = aiomysql.DictCursor
+            self.SSDictCursor = aiomysql.SSDictCursor
+
+    def sql(self, sql):
+        return sql.replace('?', '%s')
+
+    async def create_pool(self, loop, kw):
+        if aiomysql is None:
+            raise ImportError('aiomysql is required by mysql driver')
+        return (await aiomysql.create_pool(
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', 3306),
+            user=kw['user'],
+            password=kw['password'],
+            db=kw['datebase'],
+            charset=kw.get('charset', 'utf8'),
+            autocommit=kw.get('autocommit', True),
+            maxsize=kw.get('maxsize', 10),
+            minsize=kw.get('minsize', 1),
+            pool_recycle=kw.get('pool_recycle', -1),
+            loop=loop
+        ))
+
+#SQLite驱动：适合单机部署和本地压测，不需要单独的数据库服务
+#每个连接有自己的工作线程，sqlite3的连接只在这个线程里使用；打开WAL模式，读写可以并发
+#连接是autocommit的，事务用显式的BEGIN/COMMIT
+class SQLiteDriver(object):
+
+    name = 'sqlite'
+    EXPLAIN = 'explain query plan '
+    TABLE_OPTIONS = ''
+    INDEX_SQL = 'select m.name `t`, il.name `i`, ii.name `c` from sqlite_master m, pragma_index_list(m.name) il, pragma_index_info(il.name) ii where m.type = \'table\' order by m.name, il.name, ii.seqno'
+
+    Cursor = 'tuple'
+    DictCursor = 'dict'
+    SSDictCursor = 'dict'#SQLite的游标本来就是边取边读的
+
+    def sql(self, sql):
+        return sql
+
+    async def create_pool(self, loop, kw):
+        pool = SQLitePool(kw.get('path', 'awesome.db'), kw.get('minsize', 1), kw.get('maxsize', 10), kw.get('timeout', 5), loop)
+        await pool.fill()
+        return pool
+
+class SQLitePool(object):
+
+    def __init__(self, path, minsize, maxsize, timeout, loop):
+        self._path = path
+        self._minsize = minsize
+        self._maxsize = maxsize
+        self._timeout = timeout
+        self._loop = loop
+        self._free = deque()
+        self._waiters = deque()
+        self._size = 0
+
+    @property
+    def minsize(self):
+        return self._minsize
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def fill(self):
+        while self._size < self._minsize:
+            self._free.append((await self._connect()))
+
+    async def _connect(self):
+        self._size += 1
+        try:
+            conn = SQLiteConnection(self._path, self._timeout, self._loop)
+            await conn.open()
+        except BaseException:
+            self._size -= 1
+            raise
+        return conn
+
+    async def acquire(self):
+        while True:
+            if self._free:
+                return self._free.popleft()
+            if self._size < self._maxsize:
+                return await self._connect()
+            waiter = self._loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                #已经被release唤醒、同时又被取消(如wait_for超时)时，把唤醒让给下一个等待的协程
+                if waiter.done() and not waiter.cancelled():
+                    self._wakeup()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def release(self, conn):
+        self._free.append(conn)
+        self._wakeup()
+
+    def _wakeup(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    async def clear(self):
+        while self._free:
+            conn = self._free.popleft()
+            self._size -= 1
+            await conn.close()
+
+class SQLiteConnection(object):
+
+    def __init__(self, path, timeout, loop):
+        self._path = path
+        self._timeout = timeout
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._conn = None
+
+    def _run(self, fn, *args):
+        return self._loop.run_in_executor(self._executor, fn, *args)
+
+    def _open(self):
+        conn = sqlite3.connect(self._path, timeout=self._timeout, isolation_level=None, check_same_thread=False)
+        conn.execute('pragma journal_mode=wal')
+        conn.execute('pragma synchronous=normal')
+        return conn
+
+    async def open(self):
+        logging.info('open sqlite connection: %s' % self._path)
+        self._conn = await self._run(self._open)
+
+    async def cursor(self, cursorclass='tuple'):
+        return SQLiteCursor(self, cursorclass == 'dict')
+
+    async def begin(self):
+        await self._run(self._conn.execute, 'begin')
+
+    async def commit(self):
+        await self._run(self._conn.execute, 'commit')
+
+    async def rollback(self):
+        await self._run(self._conn.execute, 'rollback')
+
+    async def ping(self, reconnect=True):
+        await self._run(self._conn.execute, 'select 1')
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=False)
+
+class SQLiteCursor(object):
+
+    def __init__(self, conn, dict_rows):
+        self._conn = conn
+        self._dict_rows = dict_rows
+        self._cur = None
+        self._names = None
+        self.rowcount = -1
+
+    def _rows(self, rows):
+        if self._dict_rows:
+            return [dict(zip(self._names, r)) for r in rows]
+        return rows
+
+    def _execute(self, sql, args):
+        cur = self._conn._conn.execute(sql, args)
+        return cur, cur.rowcount, [d[0] for d in cur.description] if cur.description else None
+
+    async def execute(self, sql, args=()):
+        self._cur, self.rowcount, self._names = await self._conn._run(self._execute, sql, tuple(args or ()))
+        return self.rowcount
+
+    async def fetchmany(self, size):
+        return self._rows((await self._conn._run(self._cur.fetchmany, size)))
+
+    async def fetchall(self):
+        return self._rows((await self._conn._run(self._cur.fetchall)))
+
+    async def close(self):
+        if self._cur is not None:
+            await self._conn._run(self._cur.close)
+            self._cur = None
+
+_drivers = {
+    'mysql': MySQLDriver,
+    'sqlite': SQLiteDriver
+}
+
+def get_driver(name):
+    if name not in _drivers:
+        raise ValueError('Unknown database driver: %s' % name)
+    return _drivers[name]()
@@ -1,13 +1,16 @@
 #change on dev
 import markdown2
 
-import re, time, json, logging, hashlib, base64, asyncio
+import re, time, logging, hashlib, hmac, base64
 
 from aiohttp import web
-from coroweb import get, post
-from apis import APIValueError, APIResourceNotFoundError, APIError,Page
+from coroweb import get, post, cached, versioned
+from apis import APIValueError, APIResourceNotFoundError, APIError, APIPermissionError, CursorPage
 
 from models import User, Comment, Blog, next_id
+from orm import transaction, PoolTimeoutError
+import sqlstats
+import serializer
 from config import configs
 
 COOKIE_NAME = 'awesession'
@@ -32,6 +35,13 @@ def get_page_index(page_str):
         p = 1
     return p
 
+# 游标分页：after为空串时取第一页，否则从游标之后开始取，深翻页不会扫描丢弃前面的行
+# 列表只读，返回紧凑行对象
+async def find_by_cursor(model, after, where=None, args=None, **kw):
+    p = CursorPage(after)
+    items = await model.findAll(where, args, orderBy='created_at desc, id desc', limit=p.limit, after=p.seek, compact=True, **kw)
+    return p, p.trim(items, lambda item: (item.created_at, item.id))
+
 # 把存文本文件转为html格式的文本
 def text2html(text):
     lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<','&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
@@ -46,8 +56,7 @@ def user2cookie(user,max_age):
     return '-'.join(L)
 
 #用于解析cookie中用户信息
-@asyncio.coroutine
-def cookie2user(cookie_str):
+async def cookie2user(cookie_str):
     if not cookie_str:
         return None
     try:
@@ -57,15 +66,18 @@ def cookie2user(cookie_str):
         uid, expires, sha1 = L
         if int(expires) < time.time():
             return None
-        user = yield from User.find(uid)
+        user = await User.find(uid)
         if user is None:
             return None
         s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
+        user = User(**user)#find返回的是本次请求共用的对象，只在副本上隐藏密码
         user.passwd = '******'
         return user
+    except PoolTimeoutError:
+        raise
     except Exception as e:
         logging.exception(e)
         return None
@@ -73,21 +85,28 @@ def cookie2user(cookie_str):
 #-----------------------------------------------------用户浏览的页面-------------------------------------------------
 
 
+#首页只显示标题、摘要和时间，不需要查询正文
+INDEX_BLOG_FIELDS = ('name', 'summary', 'comment_count', 'created_at')
+#首页查询结果缓存的秒数，本进程写blogs表时会立即失效
+INDEX_CACHE_TTL = 60
+#匿名用户看到的页面缓存的秒数，本进程写相关的表时会立即失效
+PAGE_CACHE_TTL = 30
+
 #首页页面
 @get('/')
-def index(*, page='1'):
+@cached(ttl=PAGE_CACHE_TTL, tables=('blogs',))
+async def index(*, page='1', after=None):
+    if after is not None:
+        page, blogs = await find_by_cursor(Blog, after, fields=INDEX_BLOG_FIELDS)
+        return {
+            '__template__': 'blogs.html',
+            'page': page,
+            'blogs': blogs
+        }
     # 获取到要展示的博客页数是第几页
     page_index = get_page_index(page)
-    # 查找博客表里的条目数
-    num = yield from Blog.findNumber('count(id)')
-    # 通过Page类来计算当前页的相关信息
-    page = Page(num, page_index)
-    if num == 0:
-        blogs = []
-    else:
-        # 否则，根据计算出来的offset(取的初始条目index)和limit(取的条数)，来取出条目
-        blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
-        # 返回给浏览器
+    # 一次查询同时取出这一页的日志和总条数，并通过Page类来计算当前页的相关信息
+    page, blogs = await Blog.findPage(page_index, orderBy='created_at desc', fields=INDEX_BLOG_FIELDS, cache=INDEX_CACHE_TTL, compact=True)
     return {
         '__template__': 'blogs.html',
         'page': page,
@@ -96,9 +115,10 @@ def index(*, page='1'):
 
 #根据ID获取blog页面
 @get('/blog/{id}')
-def get_blog(id):
-    blog = yield from Blog.find(id)
-    comments = yield from Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+@cached(ttl=PAGE_CACHE_TTL, tables=('blogs', 'comments'))
+async def get_blog(id):
+    blog = await Blog.find(id)
+    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
     for c in comments:
         c.html_content = text2html(c.content)
     blog.html_content = markdown2.markdown(blog.content)
@@ -184,53 +204,72 @@ def manage_users(*, page='1'):
 
 #获取用户信息
 @get('/api/users')
-def api_get_users(*, page='1'):
-    page_index = get_page_index(page)
-    num = yield from User.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, users=())
-    users = yield from User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+@versioned('users')
+async def api_get_users(*, page='1', after=None):
+    if after is not None:
+        p, users = await find_by_cursor(User, after)
+        for u in users:
+            u.passwd = '******'
+        return dict(page=p, users=users)
+    p, users = await User.findPage(get_page_index(page), orderBy='created_at desc', compact=True)
     for u in users:
         u.passwd = '******'
     return dict(page=p, users=users)
 
 #找到制定Id的blog
 @get('/api/blogs/{id}')
-def api_get_blog(*, id):
-    blog = yield from Blog.find(id)
+@versioned('blogs')
+async def api_get_blog(*, id):
+    blog = await Blog.find(id)
     return blog
 
 #获取日志列表
 @get('/api/blogs')
-def api_blogs(*, page='1'):
-    page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, blogs=())
-    blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+@versioned('blogs')
+@cached(ttl=PAGE_CACHE_TTL, tables=('blogs',))
+async def api_blogs(*, page='1', after=None):
+    if after is not None:
+        p, blogs = await find_by_cursor(Blog, after)
+        return dict(page=p, blogs=blogs)
+    p, blogs = await Blog.findPage(get_page_index(page), orderBy='created_at desc', compact=True)
     return dict(page=p, blogs=blogs)
 
 #根据page获取评论
 @get('/api/comments')
-def api_comments(*, page='1'):
-    page_index = get_page_index(page)
-    num = yield from Comment.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, comments=())
-    comments = yield from Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+@versioned('comments')
+async def api_comments(*, page='1', after=None):
+    if after is not None:
+        p, comments = await find_by_cursor(Comment, after)
+        return dict(page=p, comments=comments)
+    p, comments = await Comment.findPage(get_page_index(page), orderBy='created_at desc', compact=True)
     return dict(page=p, comments=comments)
 
+#SQL执行统计，按总耗时排序，只有管理员可以看
+@get('/api/sqlstats')
+def api_sqlstats(request):
+    check_admin(request)
+    return dict(statements=sqlstats.snapshot())
+
+#Prometheus格式的SQL执行统计，管理员或带着configs.metrics.token的采集程序可以访问
+#应用在本机的反向代理后面，所有请求的对端地址都是127.0.0.1，不能按地址放行
+@get('/metrics')
+def metrics(request):
+    token = configs.metrics.token
+    auth = request.headers.get('Authorization', '')
+    if not (token and auth.startswith('Bearer ') and hmac.compare_digest(auth[7:].encode('utf-8'), token.encode('utf-8'))):
+        check_admin(request)
+    r = web.Response(body=sqlstats.prometheus().encode('utf-8'))
+    r.content_type = 'text/plain; version=0.0.4'
+    return r
+
 #登录请求
 @post('/api/authenticate')
-def authenticate(*,email,passwd):
+async def authenticate(*,email,passwd):
     if not email:
         raise APIValueError('email', 'Invalid email')
     if not passwd:
         raise APIValueError('passwd', 'Invalid  passwd')
-    users = yield from User.findAll('email=?',[email])
+    users = await User.findAll('email=?',[email])
     if len(users) ==0:#在数据库未找到该用户
         raise APIValueError('email','email not exist')
     user = users[0]#理论上只有1个
@@ -246,7 +285,7 @@ def authenticate(*,email,passwd):
     user.passwd = '******'#把密码设置成'******'不影响数据库内密码
     r.content_type = 'application/json'
     # 把对象转换成json格式返回
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serializer.dumps(user)
     return r
 
 
@@ -256,30 +295,30 @@ _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 
 #注册请求
 @post('/api/users')
-def api_register_user(*,email,name,passwd):
+async def api_register_user(*,email,name,passwd):
     if not name or not name.strip():
         raise APIValueError('name')
     if not email or not _RE_EMAIL.match(email):#注册的时候要检查email和passwd是否符合要求
         raise APIValueError('email')
     if not passwd or not _RE_SHA1.match(passwd):
         raise APIValueError('passwd')
-    users = yield from User.findAll('email=?',[email])
+    users = await User.findAll('email=?',[email])
     if len(users) > 0:
         raise APIError('register:failed', 'email', 'Email is already in use.')
     uid = next_id()#生成一个唯一的ID
     sha1_passwd = '%s:%s'%(uid,passwd)
     user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(), image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
-    yield from user.save()#存入数据库
+    await user.save()#存入数据库
     r = web.Response()
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serializer.dumps(user)
     return r
 
 #提交所写博客的数据，保存在数据库
 @post('/api/blogs')
-def api_create_blog(request, *, name, summary, content):
+async def api_create_blog(request, *, name, summary, content):
     check_admin(request)#只有管理员才可以写博客
     if not name or not name.strip():
         raise APIValueError('name', 'name cannot be empty.')
@@ -288,25 +327,28 @@ def api_create_blog(request, *, name, summary, content):
     if not content or not content.strip():
         raise APIValueError('content', 'content cannot be empty.')
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
-    yield from blog.save()
+    await blog.save()
     return blog
 
 #删除日志
 @post('/api/blogs/{id}/delete')
-def api_delete_blogs(id,request):
+async def api_delete_blogs(id,request):
     logging.info('删除博客的id为：%s'% id)
     check_admin(request)
-    b = yield from Blog.find(id)
+    b = await Blog.find(id, fields=())
     if b is None:
         raise APIResourceNotFoundError('blog')
-    yield from b.remove()
+    # 日志和它的评论在一个事务里删除
+    async with transaction():
+        await Comment.removeAll('blog_id=?', [id])
+        await b.remove()
     return dict(id=id)
 
 #编辑日志
 @post('/api/blogs/edit')
-def api_update_blog(id, request, *, name, summary, content):
+async def api_update_blog(id, request, *, name, summary, content):
     check_admin(request)
-    blog = yield from Blog.find(id)
+    blog = await Blog.find(id)
     if not name or not name.strip():
         raise APIValueError('name', 'name cannot be empty.')
     if not summary or not summary.strip():
@@ -316,12 +358,12 @@ def api_update_blog(id, request, *, name, summary, content):
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
-    yield from blog.update()
+    await blog.update()
     return blog
 
 #对某个blog发表评论
 @post('/api/blogs/{id}/comments')
-def api_create_comment(id, request, *, content):
+async def api_create_comment(id, request, *, content):
     user = request.__user__
     # 必须为登陆状态下，评论
     if user is None:
@@ -329,23 +371,27 @@ def api_create_comment(id, request, *, content):
     if not content or not content.strip():
         raise APIValueError('content')
     # 查询一下博客id是否有对应的博客
-    blog = yield from Blog.find(id)
+    blog = await Blog.find(id)
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name,
                       user_image=user.image, content=content.strip())
-    yield from comment.save()#等于对数据库表进行了insert操作，要进行保存操作
+    queue = request.app.get('comment_queue')
+    if queue is not None:
+        queue.put(comment)#放进写队列就返回，由后台批量insert，队列满时抛出QueueFullError返回429
+        return comment
+    await comment.save()#等于对数据库表进行了insert操作，要进行保存操作
     return comment
 
 #管理员删除某条评论
 @post('/api/comments/{id}/delete')
-def api_delete_comments(id, request):
+async def api_delete_comments(id, request):
     logging.info('删除的评论id是：%s' % id)
     # 先检查是否是管理员操作，只有管理员才有删除评论权限
     check_admin(request)
-    c = yield from Comment.find(id)
+    c = await Comment.find(id)
     if c is None:
         raise APIResourceNotFoundError('Comment')
-    yield from c.remove() # 有的话删除
+    await c.remove() # 有的话删除
     return dict(id=id)
 
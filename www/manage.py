@@ -0,0 +1,57 @@
+import os, sys, asyncio
+
+import orm
+import models
+import compress
+from config import configs
+
+#打印所有Model的建表和建索引语句
+def schema():
+	orm.use_driver(configs.db.get('driver', 'mysql'))
+	for model in orm._models:
+		print(orm.create_table_sql(model))
+		for sql in orm.create_index_sql(model):
+			print(sql)
+		print()
+
+#连接数据库，打印缺少的索引
+async def check(loop):
+	await orm.create_pool(loop=loop, **configs.db)
+	missing = await orm.check_indexes()
+	for sql in missing:
+		print(sql)
+	print('%s index(es) missing.' % len(missing))
+
+#建立还不存在的表和索引
+async def create(loop):
+	await orm.create_pool(loop=loop, **configs.db)
+	await orm.create_tables()
+	print('tables created.')
+
+#按子表重新计算父表上的计数缓存字段，加字段后或数据不一致时使用
+async def repair(loop):
+	await orm.create_pool(loop=loop, **configs.db)
+	for model in orm._models:
+		if model.__counter_caches__:
+			await model.repairCounterCaches()
+	print('counter caches repaired.')
+
+#为static下的css、js等文件生成预压缩的.gz和.br，由app的compress_factory直接发送
+def precompress():
+	root = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+	n = compress.precompress_dir(root, configs.compress.threshold)
+	print('%s file(s) compressed (%s).' % (n, ', '.join(compress.ENCODINGS)))
+
+if __name__ == '__main__':
+	argv = sys.argv[1:]
+	if not argv or argv[0] not in ('schema', 'check', 'create', 'repair', 'compress'):
+		print('Usage: ./manage.py schema|check|create|repair|compress')
+		exit(0)
+	if argv[0] == 'schema':
+		schema()
+	elif argv[0] == 'compress':
+		precompress()
+	else:
+		loop = asyncio.get_event_loop()
+		commands = {'check': check, 'create': create, 'repair': repair}
+		loop.run_until_complete(commands[argv[0]](loop))
@@ -2,7 +2,7 @@
 
 import uuid,time
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, IntegerField, FloatField, TextField, Index
 
 #UUID是生成ID的模块,uuid4基于随机数生成id
 def next_id():
@@ -10,9 +10,10 @@ def next_id():
 
 class User(Model):
 	__table__ = 'users'
+	__indexes__ = [Index('created_at', 'id')]
 	
 	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-	email = StringField(ddl='varchar(50)')
+	email = StringField(ddl='varchar(50)', index='unique')
 	passwd = StringField(ddl='varchar(50)')
 	admin = BooleanField()
 	name = StringField(ddl='varchar(50)')
@@ -21,6 +22,7 @@ class User(Model):
 
 class Blog(Model):
 	__table__ = 'blogs'
+	__indexes__ = [Index('created_at', 'id')]
 
 	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
 	user_id = StringField(ddl='varchar(50)')
@@ -28,11 +30,15 @@ class Blog(Model):
 	user_image = StringField(ddl='varchar(500)')
 	name = StringField(ddl='varchar(50)')
 	summary = StringField(ddl='varchar(200)')
-	content = TextField()
+	content = TextField(deferred=True)
+	comment_count = IntegerField()
 	created_at = FloatField(default=time.time)
 	
 class Comment(Model):
 	__table__ = 'comments'
+	__counters__ = ('blog_id',)
+	__counter_caches__ = [('blog_id', Blog, 'comment_count')]
+	__indexes__ = [Index('blog_id', 'created_at'), Index('created_at', 'id')]
 
 	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
 	blog_id = StringField(ddl='varchar(50)')
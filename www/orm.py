@@ -1,59 +1,556 @@
-import asyncio, logging
+import asyncio, logging, re, sys, time, weakref, itertools
 
-import aiomysql
+import sqlstats
+from drivers import get_driver
+from cache import LRUCache
+from apis import Page
 
 def log(sql, args=()):
     logging.info('SQL: %s ' % sql)
 
 #建立一个进程池用于从数据库中请求连接
-@asyncio.coroutine
-def create_pool(loop, **kw):
+#configs.db中有replicas时，为每个只读副本各建一个连接池，副本的配置覆盖主库的同名配置
+async def create_pool(loop, **kw):
     logging.info('create database connection pool...')
-    global __pool
-    __pool =yield from aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['datebase'],
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
-        loop=loop
-    )
+    global __pool, __replicas
+    global _count_ttl, _replica_policy, _read_your_writes
+    _count_ttl = kw.get('count_ttl', _count_ttl)
+    _replica_policy = kw.get('replica_policy', _replica_policy)
+    _read_your_writes = kw.get('read_your_writes', _read_your_writes)
+    global _use_identity_map
+    _use_identity_map = kw.get('identity_map', _use_identity_map)
+    _cache.maxsize = kw.get('cache_size', _cache.maxsize)
+    global _slow_query, _slow_query_interval
+    _slow_query = kw.get('slow_query', _slow_query)
+    _slow_query_interval = kw.get('slow_query_interval', _slow_query_interval)
+    use_driver(kw.get('driver', 'mysql'))
+    global _acquire_timeout, _idle_check
+    _acquire_timeout = kw.get('acquire_timeout', _acquire_timeout)
+    _idle_check = kw.get('idle_check', _idle_check)
+    __pool = await _create_pool(loop, kw)
+    __replicas = []
+    for replica in kw.get('replicas', ()):
+        rkw = dict(kw)
+        rkw.update(replica)
+        logging.info('create replica connection pool for %s:%s...' % (rkw.get('host', 'localhost'), rkw.get('port', 3306)))
+        __replicas.append((await _create_pool(loop, rkw)))
+
+async def _create_pool(loop, kw):
+    pool = await _driver.create_pool(loop, kw)
+    await _warmup(pool, kw.get('warmup', pool.minsize))
+    if kw.get('adaptive', False):
+        asyncio.ensure_future(_tune(pool, kw.get('tune_interval', 10), kw.get('grow_wait', 0.01)), loop=loop)
+    return pool
+
+#启动时先建好n个连接，第一批请求不用等建连接
+async def _warmup(pool, n):
+    n = min(n, pool.maxsize) - pool.size
+    if n <= 0:
+        return
+    logging.info('warm up %s connection(s)...' % n)
+    conns = await asyncio.gather(*[pool.acquire() for i in range(n)])
+    for conn in conns:
+        _release(conn, pool)
+
+#按等待连接的时间调整连接池：aiomysql不能在运行时改maxsize，等待时间长时提前建好连接(最多到maxsize)，
+#一直没有等待且空闲连接多于minsize时关掉空闲连接，下次取连接时再补到minsize
+_pool_waits = {} # pool -> [等待总秒数, 取连接次数]
+
+async def _tune(pool, interval, grow_wait):
+    idle_rounds = 0
+    while True:
+        await asyncio.sleep(interval)
+        total, n = _pool_waits.pop(pool, (0.0, 0))
+        avg = total / n if n else 0.0
+        if avg > grow_wait and pool.size < pool.maxsize:
+            idle_rounds = 0
+            grow = max(1, (pool.maxsize - pool.size) // 2)
+            logging.info('pool wait %.3fs, grow %s connection(s)' % (avg, grow))
+            await _warmup(pool, pool.size + grow)
+        elif avg == 0.0 and pool.freesize > pool.minsize:
+            idle_rounds += 1
+            if idle_rounds >= 3:
+                logging.info('pool idle, close %s free connection(s)' % pool.freesize)
+                await pool.clear()
+                idle_rounds = 0
+        else:
+            idle_rounds = 0
+
+#数据库驱动，由configs.db.driver选择，mysql或sqlite，见drivers.py
+_driver = get_driver('mysql')
+
+def use_driver(name):
+    global _driver
+    _driver = get_driver(name)
+
+#类里面的__pool会被改名成_类名__pool，类里面要通过这个函数取连接池
+def _get_pool():
+    return __pool
+
+def _current_task():
+    try:
+        return asyncio.current_task()
+    except AttributeError:#python3.7以前
+        return asyncio.Task.current_task()
+    except RuntimeError:#不在事件循环里
+        return None
+
+#事务中的协程固定使用同一个连接，key为Task，Task结束后自动清除
+_tx_conns = weakref.WeakKeyDictionary()
+_transactions = weakref.WeakKeyDictionary()#task -> 正在进行的Transaction
+
+#读写分离：只读语句发到副本，round_robin轮流选，least_busy选正在使用连接最少的
+#read_your_writes为True时，一个Task(即一个请求)写过主库之后的读也都走主库，避免读到副本延迟的旧数据
+__replicas = []
+_replica_policy = 'round_robin'
+_read_your_writes = True
+_replica_turn = itertools.count()
+_pinned_tasks = weakref.WeakSet()
+
+#是否配置了只读副本
+def has_replicas():
+    return bool(__replicas)
+
+def _choose_replica():
+    if _replica_policy == 'least_busy':
+        return min(__replicas, key=lambda p: p.size - p.freesize)
+    return __replicas[next(_replica_turn) % len(__replicas)]
+
+#取一个连接：当前协程在事务中时返回事务的连接，否则从连接池取，返回(连接, 要归还的连接池)
+async def _acquire(readonly=False):
+    task = _current_task()
+    conn = _tx_conns.get(task) if task is not None else None
+    if conn is not None:
+        return conn, None
+    if readonly and __replicas and task not in _pinned_tasks:
+        pool = _choose_replica()
+    else:
+        pool = __pool
+        if not readonly and _read_your_writes and task is not None:
+            _pinned_tasks.add(task)
+    conn = await _acquire_from(pool)
+    return conn, pool
+
+class PoolTimeoutError(Exception):
+    ' raised when no connection is available within acquire_timeout seconds. '
+    pass
+
+#取连接最多等_acquire_timeout秒，超时抛出PoolTimeoutError，由app返回503
+#空闲超过_idle_check秒的连接先ping一下，断开的会重连
+_acquire_timeout = 5
+_idle_check = 60
+
+async def _acquire_from(pool):
+    start = time.perf_counter()
+    try:
+        conn = await asyncio.wait_for(pool.acquire(), _acquire_timeout)
+    except asyncio.TimeoutError:
+        raise PoolTimeoutError('no database connection available in %s seconds' % _acquire_timeout)
+    wait = _pool_waits.setdefault(pool, [0.0, 0])
+    wait[0] += time.perf_counter() - start
+    wait[1] += 1
+    idle_since = getattr(conn, '_idle_since', None)
+    if idle_since is not None and time.time() - idle_since > _idle_check:
+        try:
+            await conn.ping(reconnect=True)
+        except BaseException:
+            pool.release(conn)
+            raise
+    return conn
+
+def _release(conn, pool):
+    if pool is not None:
+        conn._idle_since = time.time()
+        pool.release(conn)
+
+#查询结果缓存，key为(SQL, 参数)，用表名做tag，Model写表时删除这个表的所有缓存
+#只在本进程内失效，多进程部署时别的进程写的数据要等ttl过期才能看到
+_cache = LRUCache(maxsize=1000)
+_write_listeners = []
+
+#注册写表时的回调，参数为表名
+def add_write_listener(fn):
+    _write_listeners.append(fn)
+
+#事务中写的表先记在事务上，COMMIT成功后才让缓存失效、通知回调，回滚时丢弃
+#否则提交前别的请求读到旧数据会重新填进缓存，提交后不再有失效
+def _table_written(table):
+    task = _current_task()
+    tx = _transactions.get(task) if task is not None else None
+    if tx is not None:
+        tx._written.add(table)
+        return
+    _notify_written(table)
+
+def _notify_written(table):
+    _cache.invalidate(table)
+    for fn in _write_listeners:
+        fn(table)
 
 #封装SQL语句,conn和cur记得关闭
-@asyncio.coroutine
-def select(sql, args, size=None):
+#cache为缓存秒数，需要同时给出查询涉及的tables，事务中不使用缓存
+#tuples为True时每行返回tuple而不是dict
+async def select(sql, args, size=None, cache=None, tables=(), tuples=False):
+    key = None
+    if cache and _current_task() not in _tx_conns:
+        key = (' '.join(sql.split()), tuple(args or ()), size, tuples)
+        rs = _cache.get(key)
+        if rs is not None:
+            return list(rs)
+        generation = _cache.generation(tables)#查询期间这些表被写过时不写入缓存
+    rs = await _select(sql, args, size, tuples)
+    if key is not None:
+        _cache.set(key, rs, ttl=cache, tags=tables, generation=generation)
+        return list(rs)
+    return rs
+
+async def _select(sql, args, size=None, tuples=False):
     log(sql, args)
-    global __pool
-    with (yield from __pool) as conn:
-        cur = yield from conn.cursor(aiomysql.DictCursor)
-        yield from cur.execute(sql.replace('?', '%s'), args or ())
+    start = time.perf_counter()
+    conn, pool = await _acquire(readonly=True)
+    try:
+        acquired = time.perf_counter()
+        cur = await conn.cursor(_driver.Cursor if tuples else _driver.DictCursor)
+        await cur.execute(_driver.sql(sql), args or ())
         if size:
-            rs = yield from cur.fetchmany(size)
+            rs = await cur.fetchmany(size)
         else:
-            rs = yield from cur.fetchall()
-        yield from cur.close()
+            rs = await cur.fetchall()
+        await cur.close()
         logging.info('rows returned: %s' % len(rs))
+        duration = time.perf_counter() - acquired
+        fp = sqlstats.record(sql, duration, len(rs), acquired - start)
+        if _slow_query and duration >= _slow_query:
+            _slow_log(fp, sql, args, duration)
         return rs
+    finally:
+        _release(conn, pool)
+
+#慢查询日志：超过_slow_query秒的查询，同一指纹在_slow_query_interval秒内只记录一次
+#同时在另一个连接上执行EXPLAIN，同一时间最多一个EXPLAIN，不给数据库增加太多负担
+_slow_query = 0.5
+_slow_query_interval = 600
+_slow_logged = {}
+_explaining = False
+
+def _slow_log(fp, sql, args, duration):
+    global _explaining
+    now = time.time()
+    if now - _slow_logged.get(fp, 0) < _slow_query_interval:
+        return
+    _slow_logged[fp] = now
+    logging.warning('slow query (%.3fs) from %s: %s args: %s' % (duration, _caller(), sql, args))
+    if not _explaining:
+        _explaining = True
+        asyncio.ensure_future(_explain(sql, args))
+
+#调用栈上第一个不在orm.py里的函数，一般就是handlers里的URL处理函数
+def _caller():
+    f = sys._getframe(1)
+    while f is not None and f.f_code.co_filename == __file__:
+        f = f.f_back
+    if f is None:
+        return 'unknown'
+    return '%s:%s %s' % (f.f_code.co_filename, f.f_lineno, f.f_code.co_name)
+
+async def _explain(sql, args):
+    global _explaining
+    try:
+        conn = await _acquire_from(__pool)
+        try:
+            cur = await conn.cursor(_driver.DictCursor)
+            await cur.execute(_driver.EXPLAIN + _driver.sql(sql), args or ())
+            rs = await cur.fetchall()
+            await cur.close()
+        finally:
+            _release(conn, __pool)
+        logging.warning('explain %s\n%s' % (sql, '\n'.join(str(r) for r in rs)))
+    except Exception as e:
+        logging.warning('failed to explain %s: %s' % (sql, e))
+    finally:
+        _explaining = False
 
 #INSERT/UPDATE/DELETE语句需要的参数及返回值相同，封装在一个即可
-#应该需要commit，待解决
-@asyncio.coroutine
-def execute(sql, args):
+#连接池是autocommit的，需要多条语句一起提交时用transaction()
+async def execute(sql, args):
     log(sql)
-    with (yield from __pool) as conn:
+    start = time.perf_counter()
+    conn, pool = await _acquire()
+    try:
+        acquired = time.perf_counter()
+        cur = await conn.cursor()
+        await cur.execute(_driver.sql(sql), args)
+        affected = cur.rowcount
+        await cur.close()
+        sqlstats.record(sql, time.perf_counter() - acquired, affected, acquired - start)
+        return affected
+    finally:
+        _release(conn, pool)
+
+#在同一个连接上依次执行多条语句，返回每条语句影响的行数
+async def execute_batch(statements):
+    start = time.perf_counter()
+    conn, pool = await _acquire()
+    try:
+        wait = time.perf_counter() - start
+        cur = await conn.cursor()
+        counts = []
+        for sql, args in statements:
+            log(sql)
+            begin = time.perf_counter()
+            await cur.execute(_driver.sql(sql), args)
+            counts.append(cur.rowcount)
+            sqlstats.record(sql, time.perf_counter() - begin, cur.rowcount, wait)
+            wait = 0.0
+        await cur.close()
+        return counts
+    finally:
+        _release(conn, pool)
+
+#事务：固定使用连接池中的一个连接并关闭autocommit，事务中的save/update/remove/select都用这个连接
+#    async with orm.transaction():
+#        await Comment.removeAll('blog_id=?', [blog.id])
+#        await blog.remove()
+#不方便用async with时可以显式调用begin/commit/rollback，或者用atomic(fn, *args)在事务里执行fn:
+#    tx = await orm.transaction().begin()
+#已经在事务中时再开始的事务会加入外层事务，由外层提交或回滚
+def transaction():
+    return Transaction()
+
+class Transaction(object):
+
+    def __init__(self):
+        self._task = None
+        self._conn = None
+        self._written = set()
+
+    async def begin(self):
+        task = _current_task()
+        if task is None:
+            raise RuntimeError('transaction must be used in a task')
+        if task in _tx_conns:#加入外层事务
+            return self
+        conn = await _acquire_from(_get_pool())
         try:
-            cur = yield from conn.cursor()
-            yield from cur.execute(sql.replace('?', '%s'), args)
-            affected = cur.rowcount
-            yield from cur.close()
-        except BaseException as e:
+            await conn.begin()#BEGIN之后到COMMIT/ROLLBACK之前autocommit不生效
+        except BaseException:
+            _release(conn, _get_pool())
             raise
-        return affected
+        self._task = task
+        self._conn = conn
+        _tx_conns[task] = conn
+        _transactions[task] = self
+        if _read_your_writes:
+            _pinned_tasks.add(task)
+        return self
+
+    async def commit(self):
+        if self._conn is None:
+            return
+        try:
+            await self._conn.commit()
+        finally:
+            self._finish()
+        written, self._written = self._written, set()
+        for table in written:
+            _notify_written(table)
+
+    async def rollback(self):
+        if self._conn is None:
+            return
+        try:
+            await self._conn.rollback()
+        finally:
+            self._finish()
+            _counts.clear()#事务里save/remove已经改过行数计数，回滚后全部重新count
+            self._written.clear()
+
+    def _finish(self):
+        _tx_conns.pop(self._task, None)
+        _transactions.pop(self._task, None)
+        _release(self._conn, _get_pool())
+        self._task = None
+        self._conn = None
+
+    async def __aenter__(self):
+        return await self.begin()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.commit()
+        else:
+            await self.rollback()
+        return False
+
+#用服务端游标(SSDictCursor)流式读取大结果集，每次只取chunk行，内存占用有上限
+#读取期间一直占用一个连接，提前退出循环时要close()，或者用async with保证释放:
+#    async with Blog.iterate(chunk=500) as blogs:
+#        async for blog in blogs:
+#            ...
+class RowIterator(object):
+
+    def __init__(self, sql, args, chunk=100, factory=dict):
+        self._sql = sql
+        self._args = args
+        self._chunk = chunk
+        self._factory = factory
+        self._conn = None
+        self._pool = None
+        self._cur = None
+        self._rows = []
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._rows:
+            if self._done:
+                raise StopAsyncIteration
+            if self._cur is None:
+                log(self._sql, self._args)
+                self._conn, self._pool = await _acquire(readonly=True)
+                self._cur = await self._conn.cursor(_driver.SSDictCursor)
+                await self._cur.execute(_driver.sql(self._sql), self._args or ())
+            rows = await self._cur.fetchmany(self._chunk)
+            if not rows:
+                await self.close()
+                raise StopAsyncIteration
+            self._rows = list(reversed(rows))
+        return self._factory(self._rows.pop())
+
+    async def close(self):
+        self._done = True
+        self._rows = []
+        if self._cur is not None:
+            await self._cur.close()#服务端游标关闭时会读完剩下的结果，连接才能复用
+            self._cur = None
+        if self._conn is not None:
+            _release(self._conn, self._pool)
+            self._conn = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+#请求范围的对象缓存：同一个Task(即一个请求)里按主键find到的对象直接复用，key为(表名, 主键)
+_identity_maps = weakref.WeakKeyDictionary()
+_use_identity_map = True
+
+def _identity_map():
+    task = _current_task()
+    if not _use_identity_map or task is None:
+        return None
+    identity = _identity_maps.get(task)
+    if identity is None:
+        identity = _identity_maps[task] = {}
+    return identity
+
+def _identity_forget(table, pk=None):
+    task = _current_task()
+    identity = _identity_maps.get(task) if task is not None else None
+    if identity is None:
+        return
+    if pk is not None:
+        identity.pop((table, pk), None)
+    else:
+        for key in [k for k in identity if k[0] == table]:
+            identity.pop(key, None)
+
+#按主键批量加载：同一轮事件循环里所有协程的find(pk)合并成一条where id in (...)查询
+class _PkLoader(object):
+
+    _loaders = {}
+
+    @classmethod
+    def get(cls, model):
+        loader = cls._loaders.get(model)
+        if loader is None:
+            loader = cls._loaders[model] = cls(model)
+        return loader
+
+    def __init__(self, model):
+        self._model = model
+        self._pending = {}
+
+    def load(self, pk):
+        fut = self._pending.get(pk)
+        if fut is None:
+            loop = asyncio.get_event_loop()
+            if not self._pending:#本轮第一个请求，下一轮统一查询
+                loop.call_soon(self._dispatch)
+            fut = self._pending[pk] = loop.create_future()
+        return fut
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, {}
+        asyncio.ensure_future(self._fetch(pending))
+
+    async def _fetch(self, pending):
+        model = self._model
+        pks = list(pending.keys())
+        try:
+            if len(pks) == 1:
+                rs = await select('%s where `%s`=?' % (model.__select__, model.__primary_key__), pks, 1)
+            else:
+                rs = await select('%s where `%s` in (%s)' % (model.__select__, model.__primary_key__, create_args_string(len(pks))), pks)
+        except Exception as e:
+            for fut in pending.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        rows = dict((r[model.__primary_key__], r) for r in rs)
+        for pk, fut in pending.items():
+            if not fut.done():
+                fut.set_result(rows.get(pk))#每个调用者用这行数据自己构造对象，不同请求之间不共享对象
+
+
+#在事务里执行fn(*args)，出错回滚；已经在事务中时加入外层事务
+async def atomic(fn, *args):
+    tx = await transaction().begin()
+    try:
+        r = await fn(*args)
+    except BaseException:
+        await tx.rollback()
+        raise
+    await tx.commit()
+    return r
+
+#计数缓存：deltas为{父记录主键: 增减数}，用原子的col = col + ?更新，不会丢失并发的修改
+async def _counter_cache_add(parent, column, deltas):
+    sql = 'update `%s` set `%s` = `%s` + ? where `%s`=?' % (parent.__table__, column, column, parent.__primary_key__)
+    for pk, delta in deltas.items():
+        await execute(sql, [delta, pk])
+        _identity_forget(parent.__table__, pk)
+    _table_written(parent.__table__)
+
+#行数计数器，key为(表名, where字段, 字段值)，value为[行数, 上次从数据库校准的时间]
+#save/remove时增减，超过_count_ttl秒后重新count一次校准（多进程部署时各进程的计数以此收敛）
+_counts = {}
+_count_ttl = 60
+
+def _count_get(key):
+    entry = _counts.get(key)
+    if entry is None or time.time() - entry[1] > _count_ttl:
+        return None
+    return entry[0]
+
+def _count_set(key, num):
+    _counts[key] = [num, time.time()]
 
+def _count_add(key, delta):
+    entry = _counts.get(key)
+    if entry is not None:#没有缓存过的计数不用维护，下次查询时再count
+        entry[0] += delta
+
+def _count_drop(table, field=None):
+    for key in [k for k in _counts if k[0] == table and (field is None or k[1] == field)]:
+        _counts.pop(key, None)
+
+_RE_COUNT_WHERE = re.compile(r'^\s*`?(\w+)`?\s*=\s*\?\s*$')
 
 #待用？
 def create_args_string(num):
@@ -65,11 +562,13 @@ def create_args_string(num):
 #规定field类型，用于数据库的字段类型存储
 class Field(object):
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, index=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.deferred = False # 延迟加载的字段findAll默认不查询
+        self.index = index # True建普通索引，'unique'建唯一索引
 
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -77,8 +576,8 @@ class Field(object):
 #以下子类规定了数据类型
 class StringField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', index=False):
+        super().__init__(name, ddl, primary_key, default, index)
 
 class BooleanField(Field):
 
@@ -87,18 +586,73 @@ class BooleanField(Field):
 
 class IntegerField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False):
+        super().__init__(name, 'bigint', primary_key, default, index)
 
 class FloatField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False):
+        super().__init__(name, 'real', primary_key, default, index)
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
+    def __init__(self, name=None, default=None, deferred=False):
         super().__init__(name, 'text', False, default)#text型一定不是主键
+        self.deferred = deferred
+
+#索引声明，字段按顺序组成联合索引，最左边的字段可以单独使用
+#把查询要取的字段也放进索引就成了覆盖索引，查询不用回表，如Index('blog_id', 'created_at', 'id')
+class Index(object):
+
+    def __init__(self, *fields, unique=False, name=None):
+        self.fields = fields
+        self.unique = unique
+        self.name = name
+
+    def __str__(self):
+        return '<%s%s: %s>' % ('Unique ' if self.unique else '', self.__class__.__name__, ', '.join(self.fields))
+
+#列表页只读的紧凑行对象，由元类为每个Model生成子类，用__slots__保存字段，比dict省内存
+#直接用tuple游标的结果构造，没有查询的字段不设置；可以像Model一样用属性或[]访问，_asdict()转成dict用于JSON
+class Row(object):
+
+    __slots__ = ()
+
+    @classmethod
+    def _factory(cls, columns):
+        ' return a function building rows from tuples of the given columns. '
+        make = cls.__factories__.get(columns)
+        if make is None:
+            setters = [getattr(cls, c).__set__ for c in columns]
+            new = object.__new__
+            def make(values):
+                row = new(cls)
+                for setter, value in zip(setters, values):
+                    setter(row, value)
+                return row
+            cls.__factories__[columns] = make
+        return make
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def _asdict(self):
+        d = {}
+        for k in self.__slots__:
+            try:
+                d[k] = getattr(self, k)
+            except AttributeError:
+                pass
+        return d
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self._asdict())
 
 #元类能够动态生成类
 class ModelMetaclass(type):
@@ -133,10 +687,70 @@ class ModelMetaclass(type):
         attrs['__fields__'] = fields # 除主键外的属性名
 #构造默认的SQL语句形式
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ','.join(escaped_fields), tableName)
+        attrs['__deferred__'] = [f for f in fields if mappings[f].deferred] # 延迟加载的字段
+        attrs['__eager__'] = [primaryKey] + [f for f in fields if not mappings[f].deferred] # findAll默认查询的字段
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ','.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
+        attrs['__insert_many__'] = 'insert into `%s` (%s, `%s`) values %%s' % (tableName, ','.join(escaped_fields), primaryKey)
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ','.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
+        attrs['__update_cache__'] = {} # 按字段组合缓存生成过的update语句
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__counters__'] = tuple(attrs.get('__counters__', ())) # 需要按字段值维护行数的字段，如comments的blog_id
+        attrs['__counter_caches__'] = tuple(attrs.get('__counter_caches__', ())) # (外键字段, 父Model, 父表上的计数字段)，插入删除时维护父表的计数
+        attrs['__count_fields__'] = ('*', primaryKey, '`%s`' % primaryKey)
+        indexes = [Index(f, unique=(mappings[f].index == 'unique')) for f in fields if mappings[f].index]
+        indexes.extend(attrs.get('__indexes__', ()))
+        for index in indexes:
+            for f in index.fields:
+                if f not in mappings:
+                    raise ValueError('Invalid index field for %s: %s' % (name, f))
+            if index.name is None:
+                index.name = '%s_%s_%s' % ('uk' if index.unique else 'idx', tableName, '_'.join(index.fields))#SQLite的索引名在整个库里不能重复
+        attrs['__indexes__'] = indexes # 字段上和类上声明的所有索引
+        attrs['__row__'] = type('%sRow' % name, (Row,), dict(__slots__=tuple([primaryKey] + fields), __factories__={})) # 只读列表用的紧凑行对象
+        model = type.__new__(cls, name, bases, attrs)
+        _models.append(model)
+        return model
+
+#所有定义过的Model，用于生成表结构和检查索引
+_models = []
+
+#根据Model生成建表语句
+def create_table_sql(model):
+    lines = ['  `%s` %s not null,' % (f, model.__mappings__[f].column_type) for f in [model.__primary_key__] + model.__fields__]
+    lines.append('  primary key (`%s`)' % model.__primary_key__)
+    return 'create table `%s` (\n%s\n)%s;' % (model.__table__, '\n'.join(lines), _driver.TABLE_OPTIONS)
+
+#根据Model生成建索引语句
+def create_index_sql(model):
+    return ['create %sindex `%s` on `%s` (%s);' % ('unique ' if index.unique else '', index.name, model.__table__, ', '.join('`%s`' % f for f in index.fields)) for index in model.__indexes__]
+
+#建立还不存在的表和缺少的索引，用于SQLite单机部署和本地压测
+async def create_tables(*models):
+    for model in models or _models:
+        await execute(create_table_sql(model).replace('create table', 'create table if not exists', 1), [])
+    missing = await check_indexes(*models)
+    for sql in missing:
+        await execute(sql, [])
+
+#启动时检查数据库里缺少的索引，已有索引的最左前缀能覆盖声明的字段就算有，返回缺少的建索引语句
+async def check_indexes(*models):
+    models = models or _models
+    tables = [m.__table__ for m in models]
+    rs = await select(_driver.INDEX_SQL, [])
+    existing = {}
+    for r in rs:
+        existing.setdefault((r['t'], r['i']), []).append(r['c'])
+    missing = []
+    for model, table in zip(models, tables):
+        if not any(t == table for t, i in existing):
+            logging.warning('table not found: %s' % table)
+            continue
+        for index, sql in zip(model.__indexes__, create_index_sql(model)):
+            fields = list(index.fields)
+            if not any(t == table and cols[:len(fields)] == fields for (t, i), cols in existing.items()):
+                logging.warning('missing index on %s: %s' % (table, sql))
+                missing.append(sql)
+    return missing
 
 #利用metaclass创造的基类
 class Model(dict, metaclass=ModelMetaclass):
@@ -148,11 +762,23 @@ class Model(dict, metaclass=ModelMetaclass):
         try:
             return self[key]
         except KeyError:
+            if key in self.__mappings__:
+                raise AttributeError(r"'Model' field '%s' is not loaded, call load() first" % key)
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
+        dirty = self.__dict__.get('_dirty')
+        if dirty is not None and key in self.__mappings__ and (key not in self or self[key] != value):
+            dirty.add(key)#记录从数据库读出后改过的字段，update时只写这些字段
         self[key] = value
 
+    @classmethod
+    def _fromRow(cls, row):
+        ' build object from a database row and start tracking modified fields. '
+        obj = cls(**row)
+        object.__setattr__(obj, '_dirty', set())
+        return obj
+
     def getValue(self, key):
         return getattr(self, key, None)
 
@@ -166,17 +792,47 @@ class Model(dict, metaclass=ModelMetaclass):
                 setattr(self, key, value)
         return value
 
-    @classmethod#是方便直接用类名调用的方法，实例仍旧可以调用
-    @asyncio.coroutine
-    def findAll(cls, where=None, args=None, **kw):#cls是类名，类似于self的含义
-        ' find objects by where clause. '
-        sql = [cls.__select__]#这里的SELECT是元类中的__select__
-        if where:#规定位置
-            sql.append('where')
-            sql.append(where)
+    @classmethod
+    def _selectFields(cls, fields):
+        ' build select statement for primary key plus given fields. '
+        cols = cls._findColumns(dict(fields=fields))
+        return 'select %s from `%s`' % (','.join('`%s`' % f for f in cols), cls.__table__)
+
+    @classmethod
+    def _findColumns(cls, kw):
+        ' return selected columns for findAll, primary key first. '
+        fields = kw.get('fields', None)#只查询指定的字段，不指定时跳过延迟加载的字段
+        if fields is None:
+            return cls.__eager__
+        if kw.get('after', None) is not None:
+            fields = list(fields) + [kw.get('seekField', 'created_at')]
+        for f in fields:
+            if f not in cls.__mappings__:
+                raise ValueError('Invalid field for %s: %s' % (cls.__name__, f))
+        return [cls.__primary_key__] + [f for f in cls.__fields__ if f in fields]
+
+    @classmethod
+    def _findSQL(cls, where, args, kw):
+        ' build select statement and args for findAll and iterate. '
+        cols = ','.join('`%s`' % f for f in cls._findColumns(kw))
+        if kw.get('withCount', False):#用窗口函数在每一行带上满足条件的总行数，放在最后一列
+            cols = cols + ', count(*) over() `_num_`'
+        sql = ['select %s from `%s`' % (cols, cls.__table__)]
         if args is None:
             args = []
+        else:
+            args = list(args)
         orderBy = kw.get('orderBy', None)#规定排序
+        after = kw.get('after', None)#游标分页：只取(seekField, 主键)小于游标的行，不需要offset
+        if after is not None:
+            seekField = kw.get('seekField', 'created_at')
+            seek = '(`%s`, `%s`) < (?, ?)' % (seekField, cls.__primary_key__)
+            where = '(%s) and %s' % (where, seek) if where else seek
+            args = list(args) + list(after)
+            orderBy = '`%s` desc, `%s` desc' % (seekField, cls.__primary_key__)#必须按游标字段倒序才能保证顺序稳定
+        if where:#规定位置
+            sql.append('where')
+            sql.append(where)
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
@@ -191,50 +847,252 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = yield from select(' '.join(sql), args)#这里的select是外部select函数
-        return [cls(**r) for r in rs]#应该和return rs一样
+        return ' '.join(sql), args
+
+    @classmethod#是方便直接用类名调用的方法，实例仍旧可以调用
+    async def findAll(cls, where=None, args=None, **kw):#cls是类名，类似于self的含义
+        ' find objects by where clause. '
+        sql, args = cls._findSQL(where, args, kw)
+        compact = kw.get('compact', False)#只读的列表用紧凑行对象
+        rs = await select(sql, args, cache=kw.get('cache', None), tables=(cls.__table__,), tuples=compact)#这里的select是外部select函数
+        if compact:
+            return list(map(cls.__row__._factory(tuple(cls._findColumns(kw))), rs))
+        return [cls._fromRow(r) for r in rs]
 
     @classmethod
-    @asyncio.coroutine
-    def findNumber(cls, selectField, where=None, args=None):#找出数据库某个表中符合查询参数的条数
+    async def findPage(cls, page_index, page_size=10, where=None, args=None, **kw):
+        ' find one page of objects and the total count in one query, return (Page, objects). '
+        key = cls._countKey('count(*)', where, args)
+        num = _count_get(key) if key is not None else None
+        if num is None:#不知道总数时用count(*) over()和这一页的数据一起查出来，需要MySQL 8.0
+            sql, fargs = cls._findSQL(where, args, dict(kw, withCount=True, limit=(page_size * (page_index - 1), page_size)))
+            compact = kw.get('compact', False)
+            rs = await select(sql, fargs, cache=kw.get('cache', None), tables=(cls.__table__,), tuples=compact)
+            if len(rs) > 0:
+                num = rs[0][-1] if compact else rs[0]['_num_']
+                if key is not None:
+                    _count_set(key, num)
+                if compact:#多出来的_num_列在最后，构造时会被忽略
+                    return Page(num, page_index, page_size), list(map(cls.__row__._factory(tuple(cls._findColumns(kw))), rs))
+                return Page(num, page_index, page_size), [cls._fromRow(dict((k, v) for k, v in r.items() if k != '_num_')) for r in rs]
+            num = await cls.findNumber('count(*)', where, args)#页码超出范围时查不到行，也就拿不到总数
+        p = Page(num, page_index, page_size)
+        if p.limit == 0:
+            return p, []
+        items = await cls.findAll(where, args, **dict(kw, limit=(p.offset, p.limit)))
+        return p, items
+
+    @classmethod
+    def iterate(cls, where=None, args=None, chunk=100, **kw):
+        ' iterate objects by where clause with server side cursor, use with async for. '
+        sql, args = cls._findSQL(where, args, kw)
+        return RowIterator(sql, args, chunk, cls._fromRow)
+
+    @classmethod
+    async def findNumber(cls, selectField, where=None, args=None):#找出数据库某个表中符合查询参数的条数
         ' find number by select and where. '
+        key = cls._countKey(selectField, where, args)
+        if key is not None:
+            num = _count_get(key)
+            if num is not None:
+                return num
         sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
-        rs = yield from select(' '.join(sql), args, 1)
+        rs = await select(' '.join(sql), args, 1)
         if len(rs) == 0:
             return None
+        if key is not None:
+            _count_set(key, rs[0]['_num_'])
         return rs[0]['_num_']
 
     @classmethod
-    @asyncio.coroutine
-    def find(cls, pk):
-        ' find object by primary key. '
-        rs = yield from select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
-        if len(rs) == 0:
+    def _countKey(cls, selectField, where, args):
+        ' return counter key if the count can be maintained in memory, else None. '
+        m = re.match(r'^\s*count\((.+)\)\s*$', selectField, re.I)
+        if m is None or m.group(1).strip() not in cls.__count_fields__:
             return None
-        return cls(**rs[0])
+        if not where:
+            return (cls.__table__, None, None)
+        m = _RE_COUNT_WHERE.match(where)
+        if m and m.group(1) in cls.__counters__ and args and len(args) == 1:
+            return (cls.__table__, m.group(1), args[0])
+        return None
+
+    def _countAdd(self, delta):
+        _count_add((self.__table__, None, None), delta)
+        for f in self.__counters__:
+            _count_add((self.__table__, f, self.getValue(f)), delta)
 
-    @asyncio.coroutine
-    def save(self):
+    @classmethod
+    async def find(cls, pk, fields=None):
+        ' find object by primary key. '
+        if fields is not None:
+            rs = await select('%s where `%s`=?' % (cls._selectFields(fields), cls.__primary_key__), [pk], 1)
+            return cls._fromRow(rs[0]) if len(rs) > 0 else None
+        identity = _identity_map()
+        if identity is not None and (cls.__table__, pk) in identity:
+            return identity[(cls.__table__, pk)]
+        task = _current_task()
+        if task in _tx_conns or task in _pinned_tasks:#事务中或已写过主库时不能和别的请求合并查询
+            rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+            row = rs[0] if len(rs) > 0 else None
+        else:
+            row = await asyncio.shield(_PkLoader.get(cls).load(pk))
+        obj = cls._fromRow(row) if row is not None else None
+        if identity is not None:
+            identity[(cls.__table__, pk)] = obj
+        return obj
+
+    async def load(self, *fields):
+        ' load deferred or unselected fields of this object, all missing fields by default. '
+        fields = [f for f in (fields or self.__fields__) if f not in self]
+        if not fields:
+            return self
+        rs = await select('%s where `%s`=?' % (self._selectFields(fields), self.__primary_key__), [self.getValue(self.__primary_key__)], 1)
+        if len(rs) > 0:
+            dict.update(self, rs[0])#Model.update是写数据库的方法，这里要用dict的update
+        return self
+
+    async def save(self):
+        if self.__counter_caches__:#计数缓存字段要和插入在同一个事务里更新
+            return await atomic(self._insert)
+        await self._insert()
+
+    async def _insert(self):
         args = list(map(self.getValueOrDefault, self.__fields__))#获得非主键的值放在List中
         args.append(self.getValueOrDefault(self.__primary_key__))#把主键值放在List中
-        rows = yield from execute(self.__insert__, args)
+        rows = await execute(self.__insert__, args)
+        _identity_forget(self.__table__, self.getValue(self.__primary_key__))
+        _table_written(self.__table__)
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
+        else:
+            self._countAdd(1)
+            object.__setattr__(self, '_dirty', set())#插入之后再update只写改过的字段
+            for fk, parent, column in self.__counter_caches__:
+                await _counter_cache_add(parent, column, {self.getValue(fk): 1})
 
-    @asyncio.coroutine
-    def update(self):
-        args = list(map(self.getValue, self.__fields__))
+    @classmethod
+    async def saveMany(cls, objs, batch=100):
+        ' insert objects with multi-row insert statements, batch rows per statement. '
+        objs = list(objs)
+        statements = []
+        for i in range(0, len(objs), batch):
+            chunk = objs[i:i + batch]
+            args = []
+            for obj in chunk:
+                args.extend(map(obj.getValueOrDefault, cls.__fields__))
+                args.append(obj.getValueOrDefault(cls.__primary_key__))
+            values = ', '.join(['(%s)' % create_args_string(len(cls.__fields__) + 1)] * len(chunk))
+            statements.append((cls.__insert_many__ % values, args))
+        if not statements:
+            return []
+        if cls.__counter_caches__:
+            return await atomic(cls._insertMany, objs, statements)
+        return await cls._insertMany(objs, statements)
+
+    @classmethod
+    async def _insertMany(cls, objs, statements):
+        counts = await execute_batch(statements)
+        _table_written(cls.__table__)
+        for fk, parent, column in cls.__counter_caches__:
+            deltas = {}
+            for obj in objs:
+                deltas[obj.getValue(fk)] = deltas.get(obj.getValue(fk), 0) + 1
+            await _counter_cache_add(parent, column, deltas)
+        if sum(counts) == len(objs):
+            for obj in objs:
+                obj._countAdd(1)
+        else:
+            logging.warn('failed to insert records: affected rows: %s of %s' % (sum(counts), len(objs)))
+            _count_drop(cls.__table__)
+        return counts
+
+    async def update(self):
+        dirty = self.__dict__.get('_dirty')
+        if dirty is None:#不是从数据库读出的对象，写所有已有的字段，部分加载的对象不会把其他字段清空
+            fields = [f for f in self.__fields__ if f in self]
+        else:#从数据库读出的对象只写改过的字段
+            fields = [f for f in self.__fields__ if f in dirty]
+        if not fields:
+            return
+        sql = self._updateSQL(tuple(fields))
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = yield from execute(self.__update__, args)
+        rows = await execute(sql, args)
+        _identity_forget(self.__table__, self.getValue(self.__primary_key__))
+        _table_written(self.__table__)
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
+        for f in self.__counters__:#不知道更新前的字段值，只能丢弃按该字段的计数
+            if f in fields:
+                _count_drop(self.__table__, f)
+        object.__setattr__(self, '_dirty', set())
+
+    @classmethod
+    def _updateSQL(cls, fields):
+        ' return cached update statement for the given fields. '
+        sql = cls.__update_cache__.get(fields)
+        if sql is None:
+            if len(fields) == len(cls.__fields__):
+                sql = cls.__update__
+            else:
+                sql = 'update `%s` set %s where `%s`=?' % (cls.__table__, ','.join('`%s`=?' % f for f in fields), cls.__primary_key__)
+            cls.__update_cache__[fields] = sql
+        return sql
 
-    @asyncio.coroutine
-    def remove(self):
+    @classmethod
+    async def removeAll(cls, where, args=None):
+        ' remove objects by where clause, return affected rows. '
+        if cls.__counter_caches__:
+            return await atomic(cls._deleteAll, where, args)
+        return await cls._deleteAll(where, args)
+
+    @classmethod
+    async def _deleteAll(cls, where, args):
+        parents = []#删除前先找出受影响的父记录，删除后重新计算它们的计数
+        for fk, parent, column in cls.__counter_caches__:
+            rs = await select('select distinct `%s` `pk` from `%s` where %s' % (fk, cls.__table__, where), args)
+            parents.append([r['pk'] for r in rs])
+        rows = await execute('delete from `%s` where %s' % (cls.__table__, where), args or [])
+        _count_drop(cls.__table__)
+        _identity_forget(cls.__table__)
+        _table_written(cls.__table__)
+        if parents:
+            await cls.repairCounterCaches(parents)
+        return rows
+
+    @classmethod
+    async def repairCounterCaches(cls, pks=None):
+        ' recompute counter cache columns of parent rows, pks is a list of parent keys per counter cache. '
+        for n, (fk, parent, column) in enumerate(cls.__counter_caches__):
+            sql = 'update `%s` set `%s` = (select count(*) from `%s` where `%s`.`%s` = `%s`.`%s`)' % (parent.__table__, column, cls.__table__, cls.__table__, fk, parent.__table__, parent.__primary_key__)
+            args = []
+            if pks is not None:
+                if not pks[n]:
+                    continue
+                sql = '%s where `%s` in (%s)' % (sql, parent.__primary_key__, create_args_string(len(pks[n])))
+                args = list(pks[n])
+            rows = await execute(sql, args)
+            logging.info('repaired %s.%s for %s row(s)' % (parent.__table__, column, rows))
+            _identity_forget(parent.__table__)
+            _table_written(parent.__table__)
+
+    async def remove(self):
+        if self.__counter_caches__:
+            return await atomic(self._delete)
+        await self._delete()
+
+    async def _delete(self):
         args = [self.getValue(self.__primary_key__)]
-        rows = yield from execute(self.__delete__, args)
+        rows = await execute(self.__delete__, args)
+        _identity_forget(self.__table__, self.getValue(self.__primary_key__))
+        _table_written(self.__table__)
         if rows != 1:
             logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+        else:
+            self._countAdd(-1)
+            for fk, parent, column in self.__counter_caches__:
+                await _counter_cache_add(parent, column, {self.getValue(fk): -1})
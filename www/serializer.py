@@ -0,0 +1,84 @@
+import json, logging
+from operator import attrgetter
+
+try:
+    import orjson
+except ImportError:#可选的更快的JSON库，没装时用标准库
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+from apis import Page, CursorPage
+from orm import Row
+
+#JSON序列化：dumps(obj)返回utf-8的bytes，loads(s)接受str或bytes
+#后端可选orjson、ujson或标准库json，use_backend('auto')时按这个顺序选第一个装了的
+#Model本身是dict，各个后端都能直接编码；其它对象按类型查找编码函数，转换成dict后再编码
+
+_encoders = {}
+
+#注册某个类型的编码函数，fn(obj)返回能被JSON编码的对象
+def register(cls, fn):
+    _encoders[cls] = fn
+
+#每个Model生成的紧凑行类型用元类给出的字段列表预先生成编码函数
+#查询了所有字段的行一次取出全部属性，只查询了部分字段的行只输出设置了的字段
+def _row_encoder(cls):
+    names = cls.__slots__
+    get = attrgetter(*names)
+    def encode(row):
+        try:
+            return dict(zip(names, get(row)))
+        except AttributeError:
+            return row._asdict()
+    return encode
+
+def _resolve(cls):
+    if issubclass(cls, Row) and len(cls.__slots__) > 1:
+        return _row_encoder(cls)
+    if hasattr(cls, '_asdict'):
+        return cls._asdict
+    return vars
+
+def default(obj):
+    fn = _encoders.get(type(obj))
+    if fn is None:
+        fn = _encoders[type(obj)] = _resolve(type(obj))
+    return fn(obj)
+
+register(Page, vars)
+register(CursorPage, vars)
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=default).encode('utf-8')
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, default=default)
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False, default=default).encode('utf-8')
+
+_backends = {
+    'json': (_json_dumps, json.loads),
+    'orjson': (_orjson_dumps, orjson.loads) if orjson is not None else None,
+    'ujson': (_ujson_dumps, ujson.loads) if ujson is not None else None
+}
+
+backend = 'json'
+dumps, loads = _backends['json']
+
+#选择序列化后端，指定的库没有安装时退回标准库
+def use_backend(name='auto'):
+    global backend, dumps, loads
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'ujson' if ujson is not None else 'json'
+    if name not in _backends:
+        raise ValueError('Unknown json backend: %s' % name)
+    if _backends[name] is None:
+        logging.warning('%s is not installed, use json instead.' % name)
+        name = 'json'
+    backend = name
+    dumps, loads = _backends[name]
+    logging.info('json backend: %s' % name)
@@ -0,0 +1,105 @@
+import re, functools
+from collections import deque
+
+#SQL语句指纹：去掉字符串和数字字面量，合并in (?, ?, ...)和多行values，同一类语句统计在一起
+_RE_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_RE_NUMBER = re.compile(r'(?<![\w`])-?\d+(?:\.\d+)?(?![\w`])')
+_RE_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_RE_VALUES = re.compile(r'\(\?\+\)(?:\s*,\s*\(\?\+\))+')
+
+#orm执行的SQL来自为数不多的模板，记住最近的结果，不用每次都做正则替换
+@functools.lru_cache(maxsize=1024)
+def fingerprint(sql):
+    '''
+    Return normalized statement with literals stripped.
+    >>> fingerprint("select * from `users` where `id` in (?, ?, ?) and  age > 18 and name='x'")
+    'select * from `users` where `id` in (?+) and age > ? and name=?'
+    >>> fingerprint('insert into `t` (`a`, `b`) values (?, ?), (?, ?)')
+    'insert into `t` (`a`, `b`) values (?+)...'
+    '''
+    sql = _RE_STRING.sub('?', sql)
+    sql = _RE_NUMBER.sub('?', sql)
+    sql = _RE_LIST.sub('(?+)', sql)
+    sql = _RE_VALUES.sub('(?+)...', sql)
+    return ' '.join(sql.split())
+
+#每类语句的统计，耗时的p95用最近的SAMPLES次计算
+class StatementStats(object):
+
+    SAMPLES = 1000
+
+    def __init__(self, statement):
+        self.statement = statement
+        self.calls = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.rows = 0
+        self.wait = 0.0
+        self._samples = deque(maxlen=self.SAMPLES)
+
+    def record(self, duration, rows, wait):
+        self.calls += 1
+        self.total += duration
+        self.min = duration if self.min is None else min(self.min, duration)
+        self.max = max(self.max, duration)
+        self.rows += rows if rows > 0 else 0
+        self.wait += wait
+        self._samples.append(duration)
+
+    @property
+    def p95(self):
+        if not self._samples:
+            return 0.0
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+    def asdict(self):
+        return dict(statement=self.statement, calls=self.calls, total=self.total, min=self.min or 0.0, max=self.max,
+            avg=self.total / self.calls if self.calls else 0.0, p95=self.p95, rows=self.rows, wait=self.wait)
+
+#只在事件循环线程里记录和读取，不需要加锁
+_stats = {}
+
+#记录一次执行：duration是执行语句的秒数，wait是等待连接池的秒数，返回语句的指纹
+def record(sql, duration, rows=0, wait=0.0):
+    fp = fingerprint(sql)
+    stats = _stats.get(fp)
+    if stats is None:
+        stats = _stats[fp] = StatementStats(fp)
+    stats.record(duration, rows, wait)
+    return fp
+
+#按总耗时从大到小返回所有语句的统计
+def snapshot():
+    return sorted((s.asdict() for s in _stats.values()), key=lambda d: d['total'], reverse=True)
+
+def reset():
+    _stats.clear()
+
+def _label(s):
+    return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+#Prometheus文本格式
+def prometheus():
+    L = []
+    metrics = [
+        ('sql_calls_total', 'counter', 'Number of executions.', 'calls'),
+        ('sql_rows_total', 'counter', 'Rows returned or affected.', 'rows'),
+        ('sql_pool_wait_seconds_total', 'counter', 'Seconds spent waiting for a pooled connection.', 'wait'),
+        ('sql_duration_seconds_max', 'gauge', 'Slowest execution in seconds.', 'max'),
+    ]
+    stats = snapshot()
+    for name, kind, help, key in metrics:
+        L.append('# HELP %s %s' % (name, help))
+        L.append('# TYPE %s %s' % (name, kind))
+        for s in stats:
+            L.append('%s{statement="%s"} %s' % (name, _label(s['statement']), s[key]))
+    L.append('# HELP sql_duration_seconds Execution time in seconds.')
+    L.append('# TYPE sql_duration_seconds summary')
+    for s in stats:
+        label = _label(s['statement'])
+        L.append('sql_duration_seconds{statement="%s",quantile="0.95"} %s' % (label, s['p95']))
+        L.append('sql_duration_seconds_sum{statement="%s"} %s' % (label, s['total']))
+        L.append('sql_duration_seconds_count{statement="%s"} %s' % (label, s['calls']))
+    return '\n'.join(L) + '\n'
@@ -0,0 +1,93 @@
+import logging
+from collections import deque
+
+import orm
+
+class QueueFullError(Exception):
+    pass
+
+#写缓冲队列：请求把对象放进队列后立即返回，后台每隔interval秒把积累的对象用多行insert写入数据库
+#一次最多写batch个对象；队列里已有maxsize个对象时put抛出QueueFullError，由上层返回429让客户端稍后重试
+#关闭时close()把剩下的对象全部写完
+class WriteQueue(object):
+
+    def __init__(self, model, loop, maxsize=1000, interval=0.005, batch=100, retry=1):
+        self._model = model
+        self._loop = loop
+        self._maxsize = maxsize
+        self._interval = interval
+        self._batch = batch
+        self._retry = retry
+        self._items = deque()
+        self._handle = None#等待中的定时器
+        self._task = None#正在执行的flush
+        self._closed = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def full(self):
+        return len(self._items) >= self._maxsize
+
+    def put(self, obj):
+        if self._closed:
+            raise QueueFullError('write queue of %s is closed' % self._model.__table__)
+        if self.full():
+            raise QueueFullError('write queue of %s is full' % self._model.__table__)
+        #入队时就生成主键和默认值，返回给客户端的对象和之后写入的一致
+        obj.getValueOrDefault(self._model.__primary_key__)
+        for f in self._model.__fields__:
+            obj.getValueOrDefault(f)
+        self._items.append(obj)
+        self._schedule(self._interval)
+
+    def _schedule(self, delay):
+        if self._handle is None and self._task is None:
+            self._handle = self._loop.call_later(delay, self._start)
+
+    def _start(self):
+        self._handle = None
+        self._task = self._loop.create_task(self.flush())
+        self._task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self._task = None
+        delay = self._interval
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning('flush %s failed, retry in %ss: %s' % (self._model.__table__, self._retry, task.exception()))
+            delay = self._retry
+        if self._items and not self._closed:
+            self._schedule(delay)
+
+    async def flush(self):
+        while self._items:
+            objs = [self._items.popleft() for i in range(min(self._batch, len(self._items)))]
+            try:
+                await self._model.saveMany(objs, self._batch)
+            except orm.PoolTimeoutError:
+                #取不到连接时放回队首，稍后重试
+                self._items.extendleft(reversed(objs))
+                raise
+            except Exception as e:
+                #多行insert失败时逐条写入，只丢弃写不进去的那几条
+                logging.warning('batch insert into %s failed, saving one by one: %s' % (self._model.__table__, e))
+                for obj in objs:
+                    try:
+                        await obj.save()
+                    except Exception:
+                        logging.exception('drop %s: %s' % (self._model.__table__, obj))
+
+    async def close(self):
+        self._closed = True
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception:
+                pass
+        try:
+            await self.flush()
+        except Exception:
+            logging.exception('%s object(s) of %s lost' % (len(self._items), self._model.__table__))